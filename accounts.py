@@ -45,10 +45,6 @@ class AccountDataClient(object):
     def accounts(self):
         ''' Load all available accounts
         '''
-        # Make sure the session is still valid:
-        if not self.isauthenticated():
-            self.authenticate()
-
         # Make API Request:
         accounts = self.tdclient.request('get', '/v1/accounts')
 
@@ -87,10 +83,6 @@ class AccountDataClient(object):
     def orders(self):
         ''' Load all orders
         '''
-        # Make sure the session is still valid:
-        if not self.isauthenticated():
-            self.authenticate()
-
         # Make API Request:
         orders = self.tdclient.request('get', '/v1/orders')
 
@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+from td.client import DECODERS, TDClient
+from td.database.models import Token
+
+
+def record(symbol, path):
+    ''' Download the raw options chain response of the given symbol to a file,
+        for use as a benchmark payload
+    '''
+    client = TDClient(Token.current().token, os.environ.get('TDCLIENTID'))
+    response = client.send('get', '/v1/marketdata/chains', {'symbol': symbol})
+    with open(path, 'wb') as file:
+        file.write(response.content)
+    print('Recorded %s Chain (%.1f MB) To %s' % (symbol, len(response.content) / 1e6, path))
+
+
+def benchmark(paths, repeat=20):
+    ''' Print the mean decoding time of each recorded payload with every
+        installed JSON decoder, and the speedup over the stdlib decoder
+    '''
+    results = {}
+    for path in paths:
+        with open(path, 'rb') as file:
+            payload = file.read()
+        print('=== %s (%.1f MB)' % (path, len(payload) / 1e6))
+
+        decoded = {}
+        for name, decode in DECODERS.items():
+            decode(payload)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                decoded[name] = decode(payload)
+            results[(path, name)] = (time.perf_counter() - start) / repeat
+
+        # Every decoder has to produce the same document:
+        for name, document in decoded.items():
+            if document != decoded['json']:
+                print('WARNING: %s decoded %s differently' % (name, path))
+
+        for name in DECODERS:
+            ms = results[(path, name)] * 1000.
+            print('%-10s %10.2fms %8.2fx' % (name, ms, results[(path, 'json')] / results[(path, name)]))
+    return results
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1) and (sys.argv[1] == '--record'):
+        # Record a Payload: --record SYMBOL PATH
+        record(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) > 1:
+        benchmark(sys.argv[1:])
+    else:
+        print('Usage: python -m td.benchmarks.decoders [--record SYMBOL PATH | PATH...]')
@@ -0,0 +1,59 @@
+import re
+import sys
+from sqlalchemy import text
+from td.database.config import db_config
+
+# The hot query paths of the collector & research loaders, with the
+# parameters they are run with:
+QUERIES = [
+    ('option by symbol', 'SELECT id FROM options WHERE symbol = :symbol'),
+    ('options of tradable', 'SELECT id FROM options WHERE tradable_id = :tradable'),
+    ('values of option', 'SELECT * FROM options_data WHERE option_id = :option'),
+    ('values of fetch', 'SELECT * FROM options_data WHERE fetch_id = :fetch'),
+    ('values at time', 'SELECT * FROM options_data WHERE time = :time'),
+    ('latest fetch', 'SELECT * FROM options_fetch WHERE tradable_id = :tradable ORDER BY time DESC LIMIT 1'),
+    ('recent fetches', 'SELECT id FROM options_fetch WHERE tradable_id = :tradable AND time > :time - interval \'5 days\''),
+]
+
+
+def getparams(name):
+    ''' Get a representative set of query parameters for the given tradable
+    '''
+    query = text('''
+        SELECT t.id, f.id, f.time, o.id, o.symbol
+        FROM tradables t
+        JOIN options_fetch f ON f.tradable_id = t.id
+        JOIN options_data d ON d.fetch_id = f.id
+        JOIN options o ON o.id = d.option_id
+        WHERE t.name = :name
+        ORDER BY f.id DESC
+        LIMIT 1
+    ''')
+    tradable, fetch, time, option, symbol = db_config.session.execute(query, {'name': name}).first()
+    return {'tradable': tradable, 'fetch': fetch, 'time': time, 'option': option, 'symbol': symbol}
+
+
+def explain(name='SPY'):
+    ''' Print the EXPLAIN ANALYZE plan & execution time of each hot query, so
+        that plans can be compared before and after a migration
+    '''
+    params = getparams(name)
+    results = {}
+    for label, sql in QUERIES:
+        query = text('EXPLAIN (ANALYZE, BUFFERS) %s' % sql)
+        plan = [line for line, in db_config.session.execute(query, params)]
+        match = re.search(r'Execution Time: ([\d.]+) ms', plan[-1])
+        results[label] = float(match.group(1)) if match else None
+
+        print('=== %s' % label)
+        print('\n'.join(plan))
+    db_config.session.rollback()
+
+    print('=== Summary:')
+    for label, ms in results.items():
+        print('%-20s %10sms' % (label, ms))
+    return results
+
+
+if __name__ == '__main__':
+    explain(sys.argv[1] if len(sys.argv) > 1 else 'SPY')
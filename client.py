@@ -1,36 +1,179 @@
 import sys
+import json
 import urllib
 import logging
 import requests
 import datetime
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from td.database.models import *
 from td.database.config import db_config
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Available JSON decoders, fastest first (orjson & ujson are optional):
+DECODERS = {}
+try:
+    import orjson
+    DECODERS['orjson'] = orjson.loads
+except ImportError:
+    pass
+try:
+    import ujson
+    DECODERS['ujson'] = ujson.loads
+except ImportError:
+    pass
+DECODERS['json'] = json.loads
+
 log = logging.getLogger('td.client')
 
+def getdecoder(name=None):
+    ''' Get the JSON decoder function with the given name, or the fastest
+        available decoder
+    '''
+    if name is None:
+        return next(iter(DECODERS.values()))
+    if name not in DECODERS:
+        raise ImportError('JSON decoder %s is not installed' % name)
+    return DECODERS[name]
+
+class ChainStream(object):
+    ''' Incremental Parser of a Streamed Options Chain Response. Iterating
+        yields (date key, strike key, contract) for every contract in the
+        callExpDateMap & putExpDateMap, one at a time as the response body
+        arrives, while the top-level scalar values (interestRate,
+        underlyingPrice, ...) are collected into `meta`
+    '''
+    maps = ('callExpDateMap', 'putExpDateMap')
+
+    def __init__(self, response):
+        if ijson is None:
+            raise ImportError('Streaming options chains requires ijson (pip install ijson)')
+        self.response = response
+        self.meta = {}
+
+    def __iter__(self):
+        self.response.raw.decode_content = True
+        try:
+            path = []
+            key = None
+            builder = None
+            depth = 0
+            for event, value in ijson.basic_parse(self.response.raw, use_float=True):
+                # Build up the current list of contracts:
+                if builder is not None:
+                    builder.event(event, value)
+                    if event in ('start_map', 'start_array'):
+                        depth += 1
+                    elif event in ('end_map', 'end_array'):
+                        depth -= 1
+                    if depth == 0:
+                        if builder.value:
+                            yield path[2], key, builder.value[0]
+                        builder = None
+                    continue
+
+                if event == 'map_key':
+                    key = value
+                elif event == 'start_array' and len(path) == 3 and path[1] in self.maps:
+                    # A { strike -> [contract] } entry in an expiration date map:
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                    depth = 1
+                elif event in ('start_map', 'start_array'):
+                    path.append(key)
+                elif event in ('end_map', 'end_array'):
+                    path.pop()
+                elif len(path) == 1:
+                    self.meta[key] = value
+        finally:
+            self.response.close()
+
+        if 'error' in self.meta:
+            raise Exception(self.meta['error'])
+
 class TDClient(object):
     ''' Client For Fetching Data from the TD Ameritrade Data API
     '''
-    def __init__(self, refreshtoken, clientid):
-        '''
+    tokenpath = '/v1/oauth2/token'
+
+    def __init__(self, refreshtoken, clientid, poolsize=10, timeout=(5., 30.), retries=3, backoff=0.5, margin=60., decoder=None):
+        ''' The client holds a single connection-pooled HTTP session, so
+            requests reuse open keep-alive connections. `timeout` is a
+            (connect, read) tuple in seconds, and requests that fail with a 429
+            or 5xx are retried up to `retries` times with exponential backoff.
+
+            The access token is refreshed `margin` seconds before it expires.
+            Responses are decoded with the named `decoder` (orjson, ujson or
+            json), or the fastest one installed
         '''
         self.host = 'https://api.tdameritrade.com'
         self.refreshtoken = refreshtoken
         self.clientid = '%s@AMER.OAUTHAP' % clientid
+        self.timeout = timeout
+        self.margin = margin
+        self.decode = getdecoder(decoder)
+        self.session = self.getsession(poolsize, retries, backoff)
+        self.lock = threading.RLock()
+        self.headers = {}
+        self.expiration = None
         self.authenticate()
 
-    def request(self, method, path, data={}):
-        ''' Do a GET or POST Request with the given path and (optional) data
+    @classmethod
+    def getsession(cls, poolsize=10, retries=3, backoff=0.5):
+        ''' Create a pooled HTTP Session, with retries on rate limiting and
+            server errors
+        '''
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'POST']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=poolsize, pool_maxsize=poolsize, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        return session
+
+    def send(self, method, path, data={}, stream=False, retry=True):
+        ''' Send a GET or POST Request with the given path and (optional) data,
+            returning the raw response. The session is refreshed ahead of its
+            expiration, and re-authenticated once if the request is still
+            rejected as unauthorized
         '''
+        isauth = path == self.tokenpath
+        if isauth:
+            headers = {}
+        else:
+            self.ensureauthenticated()
+            headers = self.headers
+
         if method == 'get':
             url = '%s%s?%s' % (self.host, path, urllib.parse.urlencode(data))
-            response = requests.get(url=url, headers=self.headers).json()
+            response = self.session.get(url=url, headers=headers, timeout=self.timeout, stream=stream)
         elif method == 'post':
             url = self.host + path
-            response = requests.post(url=url, data=data, headers=self.headers).json()
+            response = self.session.post(url=url, data=data, headers=headers, timeout=self.timeout, stream=stream)
         else:
             raise Exception('Invalid HTTP Method: %s' % method)
 
+        if response.status_code == 401 and retry and not isauth:
+            log.info('Request To %s Was Unauthorized, Re-Authenticating...' % path)
+            response.close()
+            self.authenticate()
+            return self.send(method, path, data, stream=stream, retry=False)
+        return response
+
+    def request(self, method, path, data={}):
+        ''' Do a GET or POST Request with the given path and (optional) data
+        '''
+        response = self.decode(self.send(method, path, data).content)
+
         if 'error' in response:
             error = response['error']
             raise Exception(error)
@@ -38,38 +181,43 @@ class TDClient(object):
             return response
 
     def isauthenticated(self):
-        ''' Determine if the current session is authenticated by hitting a
-            simple endpoint
+        ''' Determine if the current session's access token is still valid (and
+            will be for at least another `margin` seconds)
         '''
-        try:
-            self.request('get', '/v1/accounts')
-            return True
-        except:
+        if self.expiration is None:
             return False
+        cutoff = datetime.datetime.now() + datetime.timedelta(seconds=self.margin)
+        return cutoff < self.expiration
+
+    def ensureauthenticated(self):
+        ''' Refresh the session if its access token is about to expire
+        '''
+        if not self.isauthenticated():
+            with self.lock:
+                # Another thread may have refreshed while we were waiting:
+                if not self.isauthenticated():
+                    self.authenticate()
 
     def authenticate(self):
         ''' Does an initial authentication with TD's Refresh API
         '''
-        # Reset the headers:
-        self.headers = {}
+        with self.lock:
+            # Make the POST Reauthentication Request:
+            data = {
+                'grant_type': 'refresh_token',
+                'refresh_token': self.refreshtoken,
+                'client_id': self.clientid
+            }
+            response = self.request('post', self.tokenpath, data)
 
-        # Make the POST Reauthentication Request:
-        path = '/v1/oauth2/token'
-        data = {
-            'grant_type': 'refresh_token',
-            'refresh_token': self.refreshtoken,
-            'client_id': self.clientid
-        }
-        response = self.request('post', path, data)
+            # Save the Authentication Token & Authorization Headers:
+            self.token = response['access_token']
+            self.headers = {'Authorization': 'Bearer %s' % self.token}
 
-        # Save the Authentication Token & Authorization Headers:
-        self.token = response['access_token']
-        self.headers = {'Authorization': 'Bearer %s' % self.token}
-
-        # Save the Expiration Time:
-        seconds = response['expires_in']
-        now = datetime.datetime.now()
-        self.expiration = now + datetime.timedelta(0, seconds)
+            # Save the Expiration Time:
+            seconds = response['expires_in']
+            now = datetime.datetime.now()
+            self.expiration = now + datetime.timedelta(0, seconds)
 
         log.info('Successfully Authenticated TD\'s API, until %s' % self.expiration)
 
@@ -88,6 +236,21 @@ class TDClient(object):
         args = {'symbol': symbol}
         return self.request('get', path, args)
 
+    def streamoptionschain(self, symbol):
+        ''' Gets the Full Options Chain for the Given Symbol as a ChainStream,
+            which parses the contracts incrementally as the response arrives
+        '''
+        path = '/v1/marketdata/chains'
+        args = {'symbol': symbol}
+        response = self.send('get', path, args, stream=True)
+        if response.status_code >= 400:
+            try:
+                error = self.decode(response.content).get('error', response.status_code)
+            finally:
+                response.close()
+            raise Exception(error)
+        return ChainStream(response)
+
     @classmethod
     def gettoken(cls, redirect='http://localhost', username='DJCOHEN0115'):
         ''' Step-By-Step Token Refresh Process
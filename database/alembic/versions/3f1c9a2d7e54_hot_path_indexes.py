@@ -0,0 +1,50 @@
+"""Hot path indexes
+
+Revision ID: 3f1c9a2d7e54
+Revises: a8767b429b02
+Create Date: 2026-10-18 09:12:41.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a2d7e54'
+down_revision = 'a8767b429b02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Merge any duplicated option symbols into the oldest Option with that
+    # symbol, so that the symbol index can be unique:
+    op.execute('''
+        UPDATE options_data
+        SET option_id = keep.id
+        FROM options dupe
+        JOIN (SELECT symbol, MIN(id) AS id FROM options GROUP BY symbol) keep
+            ON dupe.symbol = keep.symbol
+        WHERE options_data.option_id = dupe.id AND dupe.id <> keep.id
+    ''')
+    op.execute('''
+        DELETE FROM options dupe
+        USING options keep
+        WHERE dupe.symbol = keep.symbol AND dupe.id > keep.id
+    ''')
+
+    op.create_index(op.f('ix_options_symbol'), 'options', ['symbol'], unique=True)
+    op.create_index(op.f('ix_options_tradable_id'), 'options', ['tradable_id'], unique=False)
+    op.create_index(op.f('ix_options_data_option_id'), 'options_data', ['option_id'], unique=False)
+    op.create_index(op.f('ix_options_data_fetch_id'), 'options_data', ['fetch_id'], unique=False)
+    op.create_index(op.f('ix_options_data_time'), 'options_data', ['time'], unique=False)
+    op.create_index('ix_options_fetch_tradable_id_time', 'options_fetch', ['tradable_id', 'time'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_options_fetch_tradable_id_time', table_name='options_fetch')
+    op.drop_index(op.f('ix_options_data_time'), table_name='options_data')
+    op.drop_index(op.f('ix_options_data_fetch_id'), table_name='options_data')
+    op.drop_index(op.f('ix_options_data_option_id'), table_name='options_data')
+    op.drop_index(op.f('ix_options_tradable_id'), table_name='options')
+    op.drop_index(op.f('ix_options_symbol'), table_name='options')
@@ -0,0 +1,137 @@
+"""Partition options_data by month
+
+Revision ID: 7b2e4d91c0a8
+Revises: 3f1c9a2d7e54
+Create Date: 2026-10-18 11:40:03.902157
+
+"""
+import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b2e4d91c0a8'
+down_revision = '3f1c9a2d7e54'
+branch_labels = None
+depends_on = None
+
+COLUMNS = [
+    'created_at', 'updated_at', 'id', 'ask', 'asksize', 'bid', 'bidsize', 'close',
+    'dte', 'delta', 'gamma', 'low', 'high', 'itm', 'last', 'lastsize', 'mark',
+    'markchange', 'rho', 'theovalue', 'theovol', 'theta', 'timevalue', 'volume',
+    'vega', 'volatility', 'time', 'underlying', 'riskfree', 'openinterest',
+    'option_id', 'fetch_id',
+]
+
+
+def month(date, offset=0):
+    index = date.year * 12 + date.month - 1 + offset
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def create_table(name, partitioned):
+    kwargs = {'postgresql_partition_by': 'RANGE (time)'} if partitioned else {}
+    primarykey = ['id', 'time'] if partitioned else ['id']
+    op.create_table(name,
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.Column('id', sa.Integer(), server_default=sa.text("nextval('options_data_id_seq')"), nullable=False),
+        sa.Column('ask', sa.Numeric(), nullable=True),
+        sa.Column('asksize', sa.Numeric(), nullable=True),
+        sa.Column('bid', sa.Numeric(), nullable=True),
+        sa.Column('bidsize', sa.Numeric(), nullable=True),
+        sa.Column('close', sa.Numeric(), nullable=True),
+        sa.Column('dte', sa.Integer(), nullable=True),
+        sa.Column('delta', sa.Numeric(), nullable=True),
+        sa.Column('gamma', sa.Numeric(), nullable=True),
+        sa.Column('low', sa.Numeric(), nullable=True),
+        sa.Column('high', sa.Numeric(), nullable=True),
+        sa.Column('itm', sa.Boolean(), nullable=True),
+        sa.Column('last', sa.Numeric(), nullable=True),
+        sa.Column('lastsize', sa.Numeric(), nullable=True),
+        sa.Column('mark', sa.Numeric(), nullable=True),
+        sa.Column('markchange', sa.Numeric(), nullable=True),
+        sa.Column('rho', sa.Numeric(), nullable=True),
+        sa.Column('theovalue', sa.Numeric(), nullable=True),
+        sa.Column('theovol', sa.Numeric(), nullable=True),
+        sa.Column('theta', sa.Numeric(), nullable=True),
+        sa.Column('timevalue', sa.Numeric(), nullable=True),
+        sa.Column('volume', sa.Numeric(), nullable=True),
+        sa.Column('vega', sa.Numeric(), nullable=True),
+        sa.Column('volatility', sa.Numeric(), nullable=True),
+        sa.Column('time', sa.DateTime(), nullable=not partitioned),
+        sa.Column('underlying', sa.Numeric(), nullable=True),
+        sa.Column('riskfree', sa.Numeric(), nullable=True),
+        sa.Column('openinterest', sa.Integer(), nullable=True),
+        sa.Column('option_id', sa.Integer(), nullable=True),
+        sa.Column('fetch_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['fetch_id'], ['options_fetch.id'], ),
+        sa.ForeignKeyConstraint(['option_id'], ['options.id'], ),
+        sa.PrimaryKeyConstraint(*primarykey),
+        **kwargs
+    )
+    op.create_index(op.f('ix_options_data_option_id'), name, ['option_id'], unique=False)
+    op.create_index(op.f('ix_options_data_fetch_id'), name, ['fetch_id'], unique=False)
+    op.create_index(op.f('ix_options_data_time'), name, ['time'], unique=False)
+
+
+def drop_indexes(name):
+    op.drop_index(op.f('ix_options_data_time'), table_name=name)
+    op.drop_index(op.f('ix_options_data_fetch_id'), table_name=name)
+    op.drop_index(op.f('ix_options_data_option_id'), table_name=name)
+
+
+def upgrade():
+    # Move the existing table aside, keeping its id sequence for the new table:
+    drop_indexes('options_data')
+    op.rename_table('options_data', 'options_data_legacy')
+    op.execute('ALTER INDEX options_data_pkey RENAME TO options_data_legacy_pkey')
+    op.execute('ALTER SEQUENCE options_data_id_seq OWNED BY NONE')
+
+    # Create the partitioned table, with one partition per month of existing
+    # data (through the next two months), plus a default partition:
+    create_table('options_data', partitioned=True)
+    bind = op.get_bind()
+    first, = bind.execute(sa.text('SELECT MIN(COALESCE(time, created_at)) FROM options_data_legacy')).first()
+    today = datetime.date.today()
+    current = month(first or today)
+    while current <= month(today, 2):
+        op.execute(
+            "CREATE TABLE options_data_%s PARTITION OF options_data FOR VALUES FROM ('%s') TO ('%s')" % (
+                current.strftime('%Y_%m'),
+                current,
+                month(current, 1),
+            )
+        )
+        current = month(current, 1)
+    op.execute('CREATE TABLE options_data_default PARTITION OF options_data DEFAULT')
+
+    # Copy the existing rows over (the partition key can't be null, so rows
+    # without a time fall back to their fetch's time):
+    columns = ', '.join(COLUMNS)
+    selected = ', '.join(
+        'COALESCE(d.time, f.time, d.created_at)' if column == 'time' else 'd.%s' % column
+        for column in COLUMNS
+    )
+    op.execute(
+        'INSERT INTO options_data (%s) SELECT %s FROM options_data_legacy d '
+        'LEFT JOIN options_fetch f ON f.id = d.fetch_id' % (columns, selected)
+    )
+    op.drop_table('options_data_legacy')
+    op.execute('ALTER SEQUENCE options_data_id_seq OWNED BY options_data.id')
+
+
+def downgrade():
+    drop_indexes('options_data')
+    op.rename_table('options_data', 'options_data_partitioned')
+    op.execute('ALTER INDEX options_data_pkey RENAME TO options_data_partitioned_pkey')
+    op.execute('ALTER SEQUENCE options_data_id_seq OWNED BY NONE')
+
+    create_table('options_data', partitioned=False)
+    columns = ', '.join(COLUMNS)
+    op.execute('INSERT INTO options_data (%s) SELECT %s FROM options_data_partitioned' % (columns, columns))
+
+    # Dropping the partitioned parent drops all of its partitions:
+    op.drop_table('options_data_partitioned')
+    op.execute('ALTER SEQUENCE options_data_id_seq OWNED BY options_data.id')
@@ -0,0 +1,35 @@
+"""Delta-encoded options fetches
+
+Revision ID: c5a31e8f6d27
+Revises: 7b2e4d91c0a8
+Create Date: 2026-10-18 15:22:48.530416
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5a31e8f6d27'
+down_revision = '7b2e4d91c0a8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('options_fetch', sa.Column('keyframe_id', sa.Integer(), nullable=True))
+    op.add_column('options_fetch', sa.Column('unchanged', postgresql.ARRAY(sa.Integer()), nullable=True))
+    op.add_column('options_fetch', sa.Column('underlying', sa.Numeric(), nullable=True))
+    op.add_column('options_fetch', sa.Column('riskfree', sa.Numeric(), nullable=True))
+    op.create_foreign_key(
+        'options_fetch_keyframe_id_fkey', 'options_fetch', 'options_fetch', ['keyframe_id'], ['id'],
+    )
+
+
+def downgrade():
+    op.drop_constraint('options_fetch_keyframe_id_fkey', 'options_fetch', type_='foreignkey')
+    op.drop_column('options_fetch', 'riskfree')
+    op.drop_column('options_fetch', 'underlying')
+    op.drop_column('options_fetch', 'unchanged')
+    op.drop_column('options_fetch', 'keyframe_id')
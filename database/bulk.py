@@ -0,0 +1,69 @@
+import io
+import csv
+import logging
+import datetime
+from td.database.config import db_config
+from td.database.models import OptionData
+
+log = logging.getLogger('td.database.bulk')
+
+class OptionDataWriter(object):
+    ''' Bulk Writer for OptionData Snapshot Rows, which streams a fetch's rows
+        into the options_data table with PostgreSQL's COPY FROM STDIN, falling
+        back to the ORM when COPY isn't available
+    '''
+    def __init__(self, copy=True):
+        '''
+        '''
+        self.copy = copy
+        self.table = OptionData.__table__
+        self.columns = [column.name for column in self.table.columns if column.name != 'id']
+
+    def cancopy(self):
+        ''' Determine if the current session's connection supports COPY
+        '''
+        return self.copy and db_config.session.connection().dialect.driver == 'psycopg2'
+
+    def write(self, rows):
+        ''' Write the given list of OptionData column dicts to the database,
+            within the current session's transaction
+        '''
+        if not rows:
+            return
+        if self.cancopy():
+            # Run the COPY inside a savepoint, so that a failure leaves the
+            # outer transaction usable for the ORM fallback:
+            savepoint = db_config.session.begin_nested()
+            try:
+                self._copy(rows)
+                savepoint.commit()
+                return
+            except Exception:
+                savepoint.rollback()
+                log.exception('COPY Into %s Failed, Falling Back To The ORM...' % self.table.name)
+
+        self._orm(rows)
+
+    def _copy(self, rows):
+        ''' Stream the rows through COPY FROM STDIN as CSV
+        '''
+        now = datetime.datetime.utcnow()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            row.setdefault('created_at', now)
+            row.setdefault('updated_at', now)
+            writer.writerow([row.get(column) for column in self.columns])
+        buffer.seek(0)
+
+        statement = 'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (self.table.name, ', '.join(self.columns))
+        cursor = db_config.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(statement, buffer)
+        finally:
+            cursor.close()
+
+    def _orm(self, rows):
+        ''' Add the rows to the session as regular OptionData instances
+        '''
+        db_config.session.add_all([OptionData(**row) for row in rows])
@@ -0,0 +1,370 @@
+import os
+import logging
+import tempfile
+import numpy as np
+from numpy.lib.recfunctions import repack_fields
+from sqlalchemy import Float, Integer, any_, bindparam, cast
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.sql import func
+from td.database.config import db_config
+from td.database.models import *
+
+log = logging.getLogger('td.database.chains')
+
+# All loadable chain columns, as { name -> (column expression, numpy dtype) }:
+COLUMNS = {
+    'id': (OptionData.id, 'i8'),
+    'fetch_id': (OptionData.fetch_id, 'i8'),
+    'option_id': (OptionData.option_id, 'i8'),
+    'tradable_id': (Option.tradable_id, 'i8'),
+    'time': (OptionData.time, 'datetime64[us]'),
+    'symbol': (Option.symbol, 'U32'),
+    'type': (Option.type, 'U4'),
+    'strike': (cast(Option.strike, Float), 'f8'),
+    'expiration': (Option.expiration, 'datetime64[D]'),
+    'dte': (OptionData.dte, 'i4'),
+    'itm': (func.coalesce(OptionData.itm, False), '?'),
+    'bid': (cast(OptionData.bid, Float), 'f8'),
+    'ask': (cast(OptionData.ask, Float), 'f8'),
+    'bidsize': (cast(OptionData.bidsize, Float), 'f8'),
+    'asksize': (cast(OptionData.asksize, Float), 'f8'),
+    'mark': (cast(OptionData.mark, Float), 'f8'),
+    'last': (cast(OptionData.last, Float), 'f8'),
+    'close': (cast(OptionData.close, Float), 'f8'),
+    'theovalue': (cast(OptionData.theovalue, Float), 'f8'),
+    'theovol': (cast(OptionData.theovol, Float), 'f8'),
+    'timevalue': (cast(OptionData.timevalue, Float), 'f8'),
+    'delta': (cast(OptionData.delta, Float), 'f8'),
+    'gamma': (cast(OptionData.gamma, Float), 'f8'),
+    'theta': (cast(OptionData.theta, Float), 'f8'),
+    'vega': (cast(OptionData.vega, Float), 'f8'),
+    'rho': (cast(OptionData.rho, Float), 'f8'),
+    'volatility': (cast(OptionData.volatility, Float), 'f8'),
+    'volume': (cast(OptionData.volume, Float), 'f8'),
+    'openinterest': (func.coalesce(OptionData.openinterest, 0), 'i8'),
+    'underlying': (cast(OptionData.underlying, Float), 'f8'),
+    'riskfree': (cast(OptionData.riskfree, Float), 'f8'),
+}
+
+# The columns needed to reconstruct partial fetches:
+RECONSTRUCT = ['fetch_id', 'option_id', 'time', 'expiration']
+
+# The columns loaded when none are given:
+DEFAULT = [
+    'type', 'strike', 'expiration', 'dte', 'bid', 'ask', 'mark', 'theovalue',
+    'delta', 'gamma', 'theta', 'vega', 'volatility', 'volume', 'openinterest',
+    'underlying', 'riskfree',
+]
+
+
+def torecords(rows, columns):
+    ''' Convert the given query result rows into a structured numpy array
+    '''
+    dtype = [(column, COLUMNS[column][1]) for column in columns]
+    records = np.empty(len(rows), dtype=dtype)
+    if rows:
+        for column, values in zip(columns, zip(*rows)):
+            records[column] = np.array(values, dtype=object).astype(COLUMNS[column][1])
+    return records
+
+
+def query(columns, *filters):
+    ''' Build a query of the given columns across options_data joined with
+        options, with the given filters applied
+    '''
+    expressions = [COLUMNS[column][0].label(column) for column in columns]
+    query = db_config.session.query(*expressions).select_from(OptionData)
+    query = query.join(Option, Option.id == OptionData.option_id)
+    return query.filter(*filters)
+
+
+def restamp(records, fetch):
+    ''' Stamp the given records carried forward into a partial fetch with that
+        fetch's own id, time, underlying & risk free rate
+    '''
+    values = {
+        'fetch_id': fetch.id,
+        'time': fetch.time,
+        'underlying': float(fetch.underlying) if fetch.underlying is not None else np.nan,
+        'riskfree': float(fetch.riskfree) if fetch.riskfree is not None else np.nan,
+    }
+    for column, value in values.items():
+        if column in records.dtype.names:
+            records[column] = value
+    return records
+
+
+def loadcarried(fetch, columns):
+    ''' Load the rows that the given partial fetch carries forward: the latest
+        row of each of its unchanged options, since the fetch's keyframe
+    '''
+    if not fetch.unchanged:
+        return torecords([], columns)
+    keyframe = db_config.session.query(OptionsFetch.time).filter_by(id=fetch.keyframe_id).scalar()
+    filters = [
+        OptionData.option_id == any_(bindparam('optionids', list(fetch.unchanged), type_=ARRAY(Integer))),
+        OptionData.fetch_id >= fetch.keyframe_id,
+        OptionData.fetch_id < fetch.id,
+    ]
+    if keyframe is not None:
+        filters.append(OptionData.time >= keyframe)
+    latest = query(columns, *filters).distinct(OptionData.option_id)
+    latest = latest.order_by(OptionData.option_id, OptionData.fetch_id.desc())
+    return restamp(torecords(latest.all(), columns), fetch)
+
+
+def loadfetches(fetchids, columns=None, since=None):
+    ''' Load the options data of all of the given fetches with a single joined
+        query, as a structured numpy array sorted by fetch id. Passing the
+        earliest fetch time as `since` lets the database skip older partitions.
+        Partial fetches are all reconstructed together, with one more query
+    '''
+    columns = list(columns or DEFAULT)
+    if 'fetch_id' not in columns:
+        columns.insert(0, 'fetch_id')
+    fetchids = list(fetchids)
+    partials = db_config.session.query(OptionsFetch).filter(
+        OptionsFetch.id.in_(fetchids),
+        OptionsFetch.keyframe_id != None,
+    ).order_by(OptionsFetch.id).all()
+    partialids = set(fetch.id for fetch in partials)
+
+    records = torecords([], columns)
+    full = [id for id in fetchids if id not in partialids]
+    if full:
+        filters = [OptionData.fetch_id == any_(bindparam('fetchids', full, type_=ARRAY(Integer)))]
+        if since is not None:
+            filters.append(OptionData.time >= since)
+        rows = query(columns, *filters).order_by(OptionData.fetch_id).all()
+        records = torecords(rows, columns)
+
+    if partials:
+        records = np.concatenate([records, loadpartials(partials, columns)])
+        records = records[np.argsort(records['fetch_id'], kind='stable')]
+    return records
+
+
+def loadpartials(partials, columns):
+    ''' Load the given partial fetches (ordered by id) as full snapshots, with a
+        single query of their tradables' rows since the earliest of their
+        keyframes, reconstructed in memory
+    '''
+    loaded = columns + [column for column in RECONSTRUCT if column not in columns]
+    start = min(fetch.keyframe_id for fetch in partials)
+    starttime = db_config.session.query(OptionsFetch.time).filter_by(id=start).scalar()
+    filters = [
+        Option.tradable_id.in_(list(set(fetch.tradable_id for fetch in partials))),
+        OptionData.fetch_id >= start,
+        OptionData.fetch_id <= partials[-1].id,
+    ]
+    if starttime is not None:
+        filters.append(OptionData.time >= starttime)
+    rows = query(loaded, *filters).order_by(OptionData.fetch_id).all()
+
+    records = list(reconstruct([torecords(rows, loaded)], partials))
+    records = np.concatenate(records) if records else torecords([], loaded)
+    records = records[np.isin(records['fetch_id'], [fetch.id for fetch in partials])]
+    return repack_fields(records[columns])
+
+
+def loadfetch(fetch, columns=None):
+    ''' Load the options data of the given OptionsFetch as a structured numpy
+        array, with one record per contract. Partial fetches are reconstructed
+        into the full snapshot
+    '''
+    columns = list(columns or DEFAULT)
+    filters = [OptionData.fetch_id == fetch.id]
+    if fetch.time is not None:
+        filters.append(OptionData.time == fetch.time)
+    rows = query(columns, *filters).all()
+    records = torecords(rows, columns)
+    if fetch.keyframe_id is not None:
+        records = np.concatenate([records, loadcarried(fetch, columns)])
+    return records
+
+
+def reconstruct(batches, partials, first=None):
+    ''' Reconstruct the given partial fetches (ordered by id) in a stream of
+        record batches ordered by fetch id, by keeping the latest record of
+        every option. Options are forgotten once they've expired, so only the
+        live contracts are kept in memory. The records need all of the
+        RECONSTRUCT columns. Only the (non-empty) records of fetches from
+        `first` on are yielded
+    '''
+    slots = {}
+    latest = None
+    date = None
+    partials = list(partials)
+
+    def carry(fetch):
+        indexes = [slots[id] for id in fetch.unchanged or [] if id in slots]
+        return restamp(latest[indexes], fetch) if indexes else None
+
+    for records in batches:
+        if latest is None:
+            latest = np.empty(0, dtype=records.dtype)
+        output = []
+        bounds = np.flatnonzero(np.diff(records['fetch_id'])) + 1
+        for group in np.split(records, bounds):
+            if not len(group):
+                continue
+            while partials and partials[0].id <= group['fetch_id'][0]:
+                output.append(carry(partials.pop(0)))
+
+            # Forget the options that have expired:
+            day = group['time'][0].astype('datetime64[D]')
+            if day != date:
+                date = day
+                expired = latest['expiration'][:len(slots)] < date
+                if expired.any():
+                    ids = np.fromiter(slots, dtype='i8', count=len(slots))[~expired]
+                    latest = latest[:len(slots)][~expired]
+                    slots = dict(zip(ids.tolist(), range(len(ids))))
+
+            # Keep the latest record of every option:
+            indexes = [slots.setdefault(id, len(slots)) for id in group['option_id'].tolist()]
+            if len(slots) > len(latest):
+                latest = np.resize(latest, max(len(slots), 2 * len(latest)))
+            latest[indexes] = group
+            output.append(group)
+
+        output = [records for records in output if records is not None]
+        if output:
+            output = np.concatenate(output)
+            if first is not None:
+                output = output[output['fetch_id'] >= first]
+            if len(output):
+                yield output
+
+    while partials:
+        carried = carry(partials.pop(0))
+        if carried is not None:
+            yield carried
+
+
+def iterhistory(tradable, columns=None, since=None, batchsize=50000):
+    ''' Stream the options data of every fetch of the given tradable (since the
+        given time, if any) through a server-side cursor, yielding structured
+        numpy arrays of around `batchsize` records, ordered by fetch id.
+        Partial fetches are reconstructed into full snapshots
+    '''
+    columns = list(columns or DEFAULT)
+    if 'fetch_id' not in columns:
+        columns.insert(0, 'fetch_id')
+
+    # Partial fetches need the latest rows of every option from their keyframe
+    # on, so start streaming from the keyframe of the earliest one:
+    partials = db_config.session.query(OptionsFetch).filter(
+        OptionsFetch.tradable_id == tradable.id,
+        OptionsFetch.keyframe_id != None,
+    )
+    if since is not None:
+        partials = partials.filter(OptionsFetch.time >= since)
+    partials = partials.order_by(OptionsFetch.id).all()
+
+    loaded = list(columns)
+    start = since
+    first = None
+    if partials:
+        loaded += [column for column in RECONSTRUCT if column not in loaded]
+        if since is not None:
+            keyframe = db_config.session.query(OptionsFetch.time).filter_by(id=partials[0].keyframe_id).scalar()
+            start = min(since, keyframe) if keyframe is not None else since
+            first = db_config.session.query(func.min(OptionsFetch.id)).filter(
+                OptionsFetch.tradable_id == tradable.id,
+                OptionsFetch.time >= since,
+            ).scalar()
+
+    filters = [Option.tradable_id == tradable.id]
+    if start is not None:
+        filters.append(OptionData.time >= start)
+    statement = query(loaded, *filters).order_by(OptionData.fetch_id).statement
+    batches = (torecords(rows, loaded) for rows in db_config.streambatches(statement, batchsize=batchsize))
+    if not partials:
+        yield from batches
+        return
+    for records in reconstruct(batches, partials, first=first):
+        yield repack_fields(records[columns]) if loaded != columns else records
+
+
+def iterfetches(tradable, columns=None, since=None, batchsize=50000):
+    ''' Stream the options data of every fetch of the given tradable like
+        iterhistory, but yielding structured numpy arrays of whole fetches
+        only: the trailing fetch of each batch is held back until all of its
+        records are in
+    '''
+    pending = None
+    for batch in iterhistory(tradable, columns=columns, since=since, batchsize=batchsize):
+        if pending is not None:
+            batch = np.concatenate([pending, batch])
+        if not len(batch):
+            continue
+        last = batch['fetch_id'] == batch['fetch_id'][-1]
+        pending = batch[last]
+        if not last.all():
+            yield batch[~last]
+    if pending is not None:
+        yield pending
+
+
+class SnapshotCache(object):
+    def __init__(self, folder=None):
+        ''' On-Disk Cache of Options Chain Snapshots. Each fetch is saved (with
+            all columns) as a .npy file keyed by its fetch id the first time it
+            is loaded, and is memory-mapped from disk on every load after that.
+            Fetches are written in a single transaction and never change, so
+            cached snapshots never need to be invalidated
+        '''
+        self.folder = folder or os.environ.get('TDCHAINCACHE', os.path.expanduser('~/.td/chains'))
+
+    def path(self, fetchid):
+        ''' Get the cache file path of the given fetch id
+        '''
+        return os.path.join(self.folder, '%s.npy' % fetchid)
+
+    def load(self, fetch, columns=None):
+        ''' Load the given OptionsFetch from the cache, populating the cache
+            from the database if needed
+        '''
+        path = self.path(fetch.id)
+        if not os.path.exists(path):
+            self.save(fetch.id, loadfetch(fetch, columns=list(COLUMNS)))
+        records = np.load(path, mmap_mode='r')
+        return records[list(columns or DEFAULT)]
+
+    def save(self, fetchid, records):
+        ''' Atomically write a fetch's records to the cache
+        '''
+        os.makedirs(self.folder, exist_ok=True)
+        handle, temp = tempfile.mkstemp(dir=self.folder, suffix='.npy')
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                np.save(file, records)
+            os.replace(temp, self.path(fetchid))
+        except:
+            os.remove(temp)
+            raise
+        log.info('Cached Options Chain For Fetch %s (%s Contracts)' % (fetchid, len(records)))
+
+
+# The shared snapshot cache:
+cache = SnapshotCache()
+
+
+def loadchain(tradable, fetch=None, columns=None, cached=False):
+    ''' Load an options chain snapshot of the given tradable (or tradable name)
+        as a structured numpy array, with one record per contract. Loads the
+        most recent fetch, unless an OptionsFetch (or fetch id) is given. With
+        `cached`, the snapshot is read through the on-disk snapshot cache
+    '''
+    if isinstance(tradable, str):
+        tradable = db_config.session.query(Tradable).filter_by(name=tradable).first()
+    if fetch is None:
+        fetch = tradable.lastfetch()
+    elif not isinstance(fetch, OptionsFetch):
+        fetch = db_config.session.query(OptionsFetch).get(fetch)
+    if fetch is None:
+        return torecords([], list(columns or DEFAULT))
+    if cached:
+        return cache.load(fetch, columns=columns)
+    return loadfetch(fetch, columns=columns)
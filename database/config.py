@@ -1,25 +1,24 @@
 import os
 import functools
 from contextlib import contextmanager
-from sqlalchemy import create_engine
-from sqlalchemy.pool import NullPool
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool, QueuePool
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from flask_appbuilder import Model
 
 class DatabaseConfig(object):
-    def __init__(self, url):
-        ''' Database Connection Client
+    def __init__(self, url, pool=None):
+        ''' Database Connection Client, with connection pooling configured by
+            the given engine arguments (or by environment variables)
         '''
         self.url = url
+        self.pool = pool if pool is not None else self.poolfromenv()
         self.engine = create_engine(
             self.url,
             convert_unicode=True,
             logging_name='core',
-            poolclass=NullPool,
-            # pool_size=0,
-            # max_overflow=10,
-            # pool_timeout=10,
+            **self.pool
         )
 
         self._session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
@@ -37,6 +36,59 @@ class DatabaseConfig(object):
         url = 'postgresql://%s:%s@%s/%s' % (user, password, host, database)
         return url
 
+    @staticmethod
+    def poolfromenv():
+        ''' Get the connection pool engine arguments from environment variables.
+            POSTGRES_POOL selects the strategy:
+                - queue (default): keep a pool of open connections
+                - pgbouncer: no client-side pooling, leaving it to pgbouncer
+                - null: open a new connection for every checkout
+        '''
+        strategy = os.environ.get('POSTGRES_POOL', 'queue').lower()
+        if strategy in ('null', 'pgbouncer'):
+            return {'poolclass': NullPool}
+        elif strategy == 'queue':
+            return {
+                'poolclass': QueuePool,
+                'pool_size': int(os.environ.get('POSTGRES_POOL_SIZE', 5)),
+                'max_overflow': int(os.environ.get('POSTGRES_MAX_OVERFLOW', 10)),
+                'pool_timeout': float(os.environ.get('POSTGRES_POOL_TIMEOUT', 30)),
+                'pool_recycle': int(os.environ.get('POSTGRES_POOL_RECYCLE', 1800)),
+                'pool_pre_ping': os.environ.get('POSTGRES_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+            }
+        else:
+            raise Exception('Invalid POSTGRES_POOL Strategy: %s' % strategy)
+
+    def streambatches(self, query, params=None, batchsize=10000):
+        ''' Stream the results of the given query (a SQL string or a SQLAlchemy
+            selectable) through a server-side (named) cursor, yielding lists of
+            at most `batchsize` rows. List parameters bind as arrays, so use
+            "WHERE id = ANY(:ids)" rather than inlining ids into the SQL
+        '''
+        if isinstance(query, str):
+            query = text(query)
+        with self.engine.connect() as connection:
+            connection = connection.execution_options(stream_results=True, max_row_buffer=batchsize)
+            result = connection.execute(query, params or {})
+            while True:
+                rows = result.fetchmany(batchsize)
+                if not rows:
+                    break
+                yield rows
+
+    def stream(self, query, params=None, batchsize=10000):
+        ''' Stream the rows of the given query one at a time, see streambatches
+        '''
+        for rows in self.streambatches(query, params=params, batchsize=batchsize):
+            for row in rows:
+                yield row
+
+    def streamobjects(self, query, batchsize=1000):
+        ''' Stream the instances of the given ORM query through a server-side
+            cursor, loading `batchsize` instances at a time
+        '''
+        return query.execution_options(stream_results=True).yield_per(batchsize)
+
     def integrate_with_flask(self, new_engine, new_session):
         '''
         '''
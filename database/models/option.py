@@ -1,7 +1,9 @@
-from td.database.config import Model
+from td.database.config import Model, db_config
 from td.database.mixins import CreatedAtMixin
-from sqlalchemy import Column, Integer, Numeric, String, Boolean, ForeignKey, Date, DateTime, Enum
+from sqlalchemy import Column, Integer, Numeric, String, Boolean, ForeignKey, Date, DateTime, Enum, Index
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql import func
 
 class Option(Model, CreatedAtMixin):
     ''' Class to Represent an Option
@@ -10,13 +12,13 @@ class Option(Model, CreatedAtMixin):
     id = Column(Integer, primary_key=True)
     type = Column(String)
     description = Column(String)
-    symbol = Column(String)
+    symbol = Column(String, unique=True, index=True)
     exchange = Column(String)
     expirationtype = Column(String)
     strike = Column(Numeric)
     expiration = Column(Date)
 
-    tradable_id = Column(Integer, ForeignKey('tradables.id'))
+    tradable_id = Column(Integer, ForeignKey('tradables.id'), index=True)
     tradable = relationship('Tradable')
     values = relationship('OptionData')
 
@@ -32,7 +34,11 @@ class OptionData(Model, CreatedAtMixin):
     ''' Class to Represent an Option Data Snapshot
     '''
     __tablename__ = 'options_data'
-    id = Column(Integer, primary_key=True)
+    __table_args__ = {
+        # Partitioned by month, see td.database.partitions:
+        'postgresql_partition_by': 'RANGE (time)',
+    }
+    id = Column(Integer, primary_key=True, autoincrement=True)
     ask = Column(Numeric)
     asksize = Column(Numeric)
     bid = Column(Numeric)
@@ -56,15 +62,15 @@ class OptionData(Model, CreatedAtMixin):
     volume = Column(Numeric)
     vega = Column(Numeric)
     volatility = Column(Numeric)
-    time = Column(DateTime)
+    time = Column(DateTime, primary_key=True, index=True)
     underlying = Column(Numeric)
     riskfree = Column(Numeric)
     openinterest = Column(Integer)
 
-    option_id = Column(Integer, ForeignKey('options.id'))
+    option_id = Column(Integer, ForeignKey('options.id'), index=True)
     option = relationship('Option')
 
-    fetch_id = Column(Integer, ForeignKey('options_fetch.id'))
+    fetch_id = Column(Integer, ForeignKey('options_fetch.id'), index=True)
     fetch = relationship('OptionsFetch')
 
     # __mapper_args__ = {
@@ -78,6 +84,9 @@ class OptionsFetch(Model, CreatedAtMixin):
     '''
     '''
     __tablename__ = 'options_fetch'
+    __table_args__ = (
+        Index('ix_options_fetch_tradable_id_time', 'tradable_id', 'time'),
+    )
     id = Column(Integer, primary_key=True)
 
     tradable_id = Column(Integer, ForeignKey('tradables.id'))
@@ -88,11 +97,46 @@ class OptionsFetch(Model, CreatedAtMixin):
     volatility = Column(Numeric)
     oi = Column(Integer)
     volume = Column(Integer)
+    underlying = Column(Numeric)
+    riskfree = Column(Numeric)
+
+    # Partial (delta-encoded) fetches only store the rows that changed since
+    # the previous fetch; the rows of the `unchanged` options are carried
+    # forward from the fetches since the `keyframe` (a full fetch):
+    keyframe_id = Column(Integer, ForeignKey('options_fetch.id'))
+    unchanged = Column(ARRAY(Integer))
 
     # __mapper_args__ = {
     #     'order_by': time
     # }
 
+    @classmethod
+    def totals(cls, ids):
+        ''' Get the total volume & open interest of each of the given fetches
+            with a single aggregate query, as { fetch id -> (volume, oi) }
+        '''
+        if not ids:
+            return {}
+        query = db_config.session.query(
+            OptionData.fetch_id,
+            func.coalesce(func.sum(OptionData.volume), 0),
+            func.coalesce(func.sum(OptionData.openinterest), 0),
+        ).filter(OptionData.fetch_id.in_(ids)).group_by(OptionData.fetch_id)
+        totals = {id: (int(volume), int(oi)) for id, volume, oi in query}
+
+        # Partial fetches don't store every row, so use the totals recorded when
+        # they were fetched:
+        query = db_config.session.query(cls.id, cls.volume, cls.oi).filter(cls.id.in_(ids), cls.keyframe_id != None)
+        totals.update({id: (volume or 0, oi or 0) for id, volume, oi in query})
+        return totals
+
+    @property
+    def partial(self):
+        ''' Whether this fetch only stores the rows that changed since the
+            previous fetch
+        '''
+        return self.keyframe_id is not None
+
     @property
     def cststring(self):
         ''' Convert the given datetime into a CST String
@@ -109,37 +153,16 @@ class OptionsFetch(Model, CreatedAtMixin):
     def spot(self):
         ''' Gets the spot price for this surface fetch
         '''
+        if self.underlying is not None:
+            return float(self.underlying)
         sample = self.values[0]
         return float(sample.underlying)
 
     def ivrank(self):
         ''' Gets the IV Rank of this Options Fetch
         '''
-        ivs = [iv for date, iv in self.tradable.volatilities()]
-        current = self.volatility
-        if ivs and current:
-            items = sorted(ivs)
-            length = len(items)
-            item = float(current)
-
-            # Get the percentiles of each of the items:
-            percentiles = [i / float(length - 1) for i, _ in enumerate(items)]
-
-            try:
-                # Item is in list:
-                minindex = items.index(item)
-                maxindex = length - list(reversed(items)).index(item) - 1
-                return (percentiles[minindex] + percentiles[maxindex]) / 2. * 100.
-            except ValueError:
-                # This item is not in the list, so get the percentile of the closest
-                # upper and lower numbers and average those two to get the result:
-                uppers = filter(lambda x: x > item, items)
-                lowers = filter(lambda x: x < item, items)
-                upper = min(uppers) if uppers else items[-1]
-                lower = max(lowers) if lowers else items[0]
-
-                upperindex = items.index(upper)
-                lowerindex = length - list(reversed(items)).index(lower) - 1
-                return (percentiles[upperindex] + percentiles[lowerindex]) / 2. * 100.
+        from td.database.volatility import VolatilityIndex
+        if self.volatility:
+            return VolatilityIndex.get(self.tradable_id).rank(self.volatility)
         else:
             return None
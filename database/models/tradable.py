@@ -1,5 +1,6 @@
-from td.database.config import Model
+from td.database.config import Model, db_config
 from td.database.mixins import CreatedAtMixin
+from td.database.models.option import OptionsFetch
 from sqlalchemy import Column, Integer, Numeric, String, Boolean, ForeignKey, Date, DateTime, Enum
 from sqlalchemy.orm import relationship
 
@@ -17,20 +18,14 @@ class Tradable(Model, CreatedAtMixin):
     def volatilities(self):
         ''' Returns a list of 2-tuples of datetimes/volatilities for this tradable
         '''
-        return sorted([
-            (f.time, float(f.volatility))
-            for f in self.fetches
-            if f.volatility
-        ])
+        from td.database.volatility import VolatilityIndex
+        return VolatilityIndex.get(self.id).volatilities()
 
     def lastfetch(self):
         ''' Get the most recent options fetch for this tradable
         '''
-        fetches = self.fetches
-        if fetches:
-            return max(fetches, key=lambda x: x.time)
-        else:
-            return None
+        query = db_config.session.query(OptionsFetch).filter_by(tradable_id=self.id)
+        return query.order_by(OptionsFetch.time.desc()).first()
 
     def ivrank(self):
         ''' Try to get the most recent IV Rank for this tradable
@@ -0,0 +1,102 @@
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+from td.database.config import db_config
+from td.database.models import Option
+
+log = logging.getLogger('td.database.optionids')
+
+class OptionIdCache(object):
+    def __init__(self, maxsize=250000):
+        ''' Per-Process Cache of { option symbol -> option id }. Options never
+            change once created, so cached ids never need to be invalidated;
+            options are only evicted once they expire, or when the cache grows
+            past `maxsize` symbols (least recently used first)
+        '''
+        self.maxsize = maxsize
+        self.ids = OrderedDict()
+        self.expirations = {}
+        self.symbols = {}
+        self.warmed = set()
+        self.swept = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def warm(self, tradable):
+        ''' Load the ids of all of the given tradable's unexpired options, the
+            first time the tradable is seen
+        '''
+        if tradable.id in self.warmed:
+            return
+        query = db_config.session.query(Option.symbol, Option.id, Option.expiration).filter(
+            Option.tradable_id == tradable.id,
+            Option.expiration >= datetime.date.today(),
+        )
+        options = query.all()
+        self.update(options)
+        with self.lock:
+            self.warmed.add(tradable.id)
+        log.info('Cached %s Option Ids For %s' % (len(options), tradable))
+
+    def get(self, symbol):
+        ''' Get the cached id of the given option symbol, or None
+        '''
+        with self.lock:
+            id = self.ids.get(symbol)
+            if id is not None:
+                self.ids.move_to_end(symbol)
+            return id
+
+    def lookup(self, symbols):
+        ''' Get the cached ids of the given option symbols, as a mapping of
+            { symbol -> option id } and a list of the uncached symbols
+        '''
+        ids = {}
+        missing = []
+        with self.lock:
+            for symbol in symbols:
+                id = self.ids.get(symbol)
+                if id is None:
+                    missing.append(symbol)
+                else:
+                    ids[symbol] = id
+                    self.ids.move_to_end(symbol)
+        return ids, missing
+
+    def update(self, options):
+        ''' Cache the given (symbol, id, expiration) options. Only options that
+            are committed to the database should be cached
+        '''
+        with self.lock:
+            for symbol, id, expiration in options:
+                self.ids[symbol] = id
+                self.ids.move_to_end(symbol)
+                self.expirations.setdefault(expiration, set()).add(symbol)
+                self.symbols[symbol] = expiration
+            self.evict()
+
+    def evict(self):
+        ''' Drop all expired options (once a day), and then the least recently
+            used options beyond the size limit
+        '''
+        today = datetime.date.today()
+        if self.swept != today:
+            for expiration in [date for date in self.expirations if date is not None and date < today]:
+                for symbol in self.expirations.pop(expiration):
+                    self.ids.pop(symbol, None)
+                    self.symbols.pop(symbol, None)
+            self.swept = today
+        while len(self.ids) > self.maxsize:
+            symbol, _ = self.ids.popitem(last=False)
+            expiration = self.symbols.pop(symbol)
+            symbols = self.expirations[expiration]
+            symbols.discard(symbol)
+            if not symbols:
+                del self.expirations[expiration]
+
+
+# The shared option id cache:
+cache = OptionIdCache()
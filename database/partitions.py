@@ -0,0 +1,120 @@
+import sys
+import logging
+import datetime
+from sqlalchemy import text
+from td.database.config import db_config
+
+log = logging.getLogger('td.database.partitions')
+
+class Partitions(object):
+    ''' Manages the monthly range partitions of the options_data table, named
+        options_data_YYYY_MM. Rows outside of every monthly partition land in
+        options_data_default, so partitions should be created ahead of time
+    '''
+    table = 'options_data'
+
+    @classmethod
+    def month(cls, date, offset=0):
+        ''' Get the first day of the month `offset` months after the given date
+        '''
+        index = date.year * 12 + date.month - 1 + offset
+        return datetime.date(index // 12, index % 12 + 1, 1)
+
+    @classmethod
+    def name(cls, month):
+        ''' Get the partition name for the given month
+        '''
+        return '%s_%s' % (cls.table, month.strftime('%Y_%m'))
+
+    @classmethod
+    def existing(cls):
+        ''' Get a { month -> partition name } mapping of all monthly partitions
+        '''
+        query = text('''
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = :table
+        ''')
+        partitions = {}
+        for name, in db_config.session.execute(query, {'table': cls.table}):
+            try:
+                month = datetime.datetime.strptime(name[len(cls.table) + 1:], '%Y_%m').date()
+                partitions[month] = name
+            except ValueError:
+                # Skip the default partition:
+                continue
+        return partitions
+
+    @classmethod
+    def create(cls, month):
+        ''' Create the partition of the given month. Rows of that month that
+            already landed in the default partition would block the partition
+            from being created, so the default partition is detached while
+            they're moved into the new partition, and then reattached
+        '''
+        name = cls.name(month)
+        default = '%s_default' % cls.table
+        bounds = {'start': month, 'end': cls.month(month, 1)}
+        partition = "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')" % (
+            name,
+            cls.table,
+            bounds['start'],
+            bounds['end'],
+        )
+
+        stranded = db_config.session.execute(text(
+            'SELECT COUNT(*) FROM %s WHERE time >= :start AND time < :end' % default
+        ), bounds).scalar()
+        if not stranded:
+            log.info('Creating Partition %s...' % name)
+            db_config.session.execute(text(partition))
+            return
+
+        log.warning('Creating Partition %s, Moving %s Rows Out Of %s...' % (name, stranded, default))
+        db_config.session.execute(text('ALTER TABLE %s DETACH PARTITION %s' % (cls.table, default)))
+        db_config.session.execute(text(partition))
+        db_config.session.execute(text(
+            'WITH moved AS (DELETE FROM %s WHERE time >= :start AND time < :end RETURNING *) '
+            'INSERT INTO %s SELECT * FROM moved' % (default, cls.table)
+        ), bounds)
+        db_config.session.execute(text('ALTER TABLE %s ATTACH PARTITION %s DEFAULT' % (cls.table, default)))
+
+    @classmethod
+    def ensure(cls, ahead=2):
+        ''' Create the partitions for the current month and the next `ahead`
+            months, if they don't exist yet
+        '''
+        today = datetime.date.today()
+        existing = cls.existing()
+        for offset in range(ahead + 1):
+            month = cls.month(today, offset)
+            if month not in existing:
+                cls.create(month)
+        db_config.session.commit()
+
+    @classmethod
+    def retain(cls, months=12, drop=False):
+        ''' Detach every partition that ends more than `months` months ago from
+            the options_data table, and optionally drop it
+        '''
+        cutoff = cls.month(datetime.date.today(), -months)
+        detached = []
+        for month, name in sorted(cls.existing().items()):
+            if cls.month(month, 1) <= cutoff:
+                log.info('Detaching Partition %s...' % name)
+                db_config.session.execute(text('ALTER TABLE %s DETACH PARTITION %s' % (cls.table, name)))
+                if drop:
+                    log.info('Dropping Partition %s...' % name)
+                    db_config.session.execute(text('DROP TABLE %s' % name))
+                detached.append(name)
+        db_config.session.commit()
+        return detached
+
+
+if __name__ == '__main__':
+    Partitions.ensure()
+    if (len(sys.argv) > 1) and (sys.argv[1] == '--retain'):
+        months = int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2].isdigit() else 12
+        Partitions.retain(months=months, drop='--drop' in sys.argv)
@@ -0,0 +1,137 @@
+import time
+import heapq
+import bisect
+import datetime
+import threading
+from td.database.config import db_config
+from td.database.models import OptionsFetch
+
+class VolatilityIndex(object):
+    ''' Sorted index of a Tradable's OptionsFetch volatilities, for O(log n) IV
+        Rank lookups. Indexes are cached per tradable, and are kept up to date
+        incrementally, by loading only the fetches updated since the last
+        refresh
+    '''
+    indexes = {}
+    lock = threading.Lock()
+
+    # Overlap between refreshes, to catch updates committed out of order:
+    overlap = datetime.timedelta(minutes=5)
+
+    def __init__(self, tradableid, window=None, ttl=60.):
+        ''' Only fetches from the last `window` days are indexed, if given, and
+            the index is refreshed from the database at most every `ttl` seconds
+        '''
+        self.tradableid = tradableid
+        self.window = window
+        self.ttl = ttl
+
+        self.vols = []
+        self.fetches = {}
+        self.times = []
+        self.synced = None
+        self.checked = 0.
+        self.rlock = threading.RLock()
+
+    @classmethod
+    def get(cls, tradableid, window=None):
+        ''' Get the (refreshed) cached index for the given tradable id
+        '''
+        key = (tradableid, window)
+        with cls.lock:
+            if key not in cls.indexes:
+                cls.indexes[key] = cls(tradableid, window=window)
+            index = cls.indexes[key]
+        index.refresh()
+        return index
+
+    def cutoff(self):
+        ''' Get the earliest fetch time included in this index
+        '''
+        if self.window is None:
+            return None
+        return datetime.datetime.now() - datetime.timedelta(days=self.window)
+
+    def refresh(self, force=False):
+        ''' Load all of the tradable's fetches updated since the last refresh
+        '''
+        with self.rlock:
+            if not force and time.time() - self.checked < self.ttl:
+                return
+            query = db_config.session.query(
+                OptionsFetch.id,
+                OptionsFetch.time,
+                OptionsFetch.volatility,
+                OptionsFetch.updated_at,
+            ).filter(OptionsFetch.tradable_id == self.tradableid)
+            if self.synced is not None:
+                query = query.filter(OptionsFetch.updated_at >= self.synced - self.overlap)
+            cutoff = self.cutoff()
+            if cutoff is not None:
+                query = query.filter(OptionsFetch.time >= cutoff)
+
+            for id, fetchtime, volatility, updated in query:
+                self.record(id, fetchtime, volatility)
+                if updated is not None and (self.synced is None or updated > self.synced):
+                    self.synced = updated
+
+            self.evict()
+            self.checked = time.time()
+
+    def record(self, id, fetchtime, volatility):
+        ''' Add (or update) the given fetch's volatility in the index
+        '''
+        with self.rlock:
+            previous = self.fetches.pop(id, None)
+            if previous is not None:
+                del self.vols[bisect.bisect_left(self.vols, previous[1])]
+            if volatility:
+                volatility = float(volatility)
+                self.fetches[id] = (fetchtime, volatility)
+                bisect.insort(self.vols, volatility)
+
+                # Fetch times are only needed to evict from a rolling window:
+                if self.window is not None and (previous is None or previous[0] != fetchtime):
+                    heapq.heappush(self.times, (fetchtime, id))
+
+    def evict(self):
+        ''' Drop all fetches that have fallen out of the rolling window
+        '''
+        cutoff = self.cutoff()
+        if cutoff is None:
+            return
+        with self.rlock:
+            while self.times and self.times[0][0] < cutoff:
+                fetchtime, id = heapq.heappop(self.times)
+                if id in self.fetches and self.fetches[id][0] == fetchtime:
+                    self.record(id, fetchtime, None)
+
+    def volatilities(self):
+        ''' Returns a sorted list of 2-tuples of datetimes/volatilities
+        '''
+        with self.rlock:
+            return sorted(self.fetches.values())
+
+    def rank(self, volatility):
+        ''' Get the IV Rank (0 - 100) of the given volatility against the index,
+            averaging the percentiles of its equal (or else its neighbouring)
+            volatilities
+        '''
+        with self.rlock:
+            items = self.vols
+            length = len(items)
+            if length < 2 or not volatility:
+                return None
+            item = float(volatility)
+
+            lower = bisect.bisect_left(items, item)
+            upper = bisect.bisect_right(items, item)
+            if lower < upper:
+                # Item is in the index:
+                minindex, maxindex = lower, upper - 1
+            else:
+                # Item is not in the index, so use the closest upper and lower
+                # items (or the ends of the index):
+                minindex = lower - 1 if lower > 0 else bisect.bisect_right(items, items[0]) - 1
+                maxindex = lower if lower < length else bisect.bisect_left(items, items[-1])
+            return (minindex + maxindex) / 2. / (length - 1) * 100.
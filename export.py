@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import logging
+import argparse
+import datetime
+import numpy as np
+from sqlalchemy import text
+from td.database.config import db_config
+from td.database.models import Option, OptionData, OptionsFetch, Tradable
+from td.database.chains import RECONSTRUCT, query, reconstruct, torecords
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+log = logging.getLogger('td.export')
+
+# Exported columns (see td.database.chains.COLUMNS), as (name, arrow type name):
+COLUMNS = [
+    ('fetch_id', 'int64'),
+    ('time', 'timestamp'),
+    ('symbol', 'string'),
+    ('type', 'string'),
+    ('strike', 'float64'),
+    ('expiration', 'date32'),
+    ('dte', 'int64'),
+    ('itm', 'bool'),
+    ('bid', 'float64'),
+    ('ask', 'float64'),
+    ('bidsize', 'float64'),
+    ('asksize', 'float64'),
+    ('mark', 'float64'),
+    ('last', 'float64'),
+    ('close', 'float64'),
+    ('theovalue', 'float64'),
+    ('theovol', 'float64'),
+    ('timevalue', 'float64'),
+    ('delta', 'float64'),
+    ('gamma', 'float64'),
+    ('theta', 'float64'),
+    ('vega', 'float64'),
+    ('rho', 'float64'),
+    ('volatility', 'float64'),
+    ('volume', 'float64'),
+    ('openinterest', 'int64'),
+    ('underlying', 'float64'),
+    ('riskfree', 'float64'),
+]
+
+
+class ParquetExporter(object):
+    def __init__(self, folder, batchsize=50000, lag=10):
+        ''' Streaming Exporter of options_data (joined with options) into
+            Parquet files, partitioned as <folder>/tradable=<name>/date=<date>/.
+
+            Rows are read through a server-side cursor `batchsize` rows at a
+            time, so memory use stays bounded regardless of history size. The
+            last exported fetch id is kept as a watermark in the folder, so
+            incremental exports only pick up newer fetches. Fetches from the
+            last `lag` minutes are left for the next export, so that fetches
+            still being committed are never skipped. Full exports are written
+            to a staging folder, and each partition they rewrite is swapped in
+            (replacing the earlier exports' files) once the export succeeds.
+            Partial (delta-encoded) fetches are exported as full snapshots
+        '''
+        self.folder = folder
+        self.batchsize = batchsize
+        self.lag = lag
+        # The open Parquet file of each tradable, as { name -> (date, writer) }:
+        self.writers = {}
+        # The folder a full export is staged in, until it's swapped in:
+        self.staging = None
+
+    @property
+    def watermarkpath(self):
+        return os.path.join(self.folder, '_watermark.json')
+
+    def getwatermarks(self):
+        ''' Get the { tradables key -> last exported fetch id } watermarks
+        '''
+        if not os.path.exists(self.watermarkpath):
+            return {}
+        with open(self.watermarkpath) as file:
+            return json.load(file)
+
+    def getwatermark(self, key):
+        ''' Get the id of the last exported fetch for the given tradables key
+        '''
+        return self.getwatermarks().get(key, 0)
+
+    def setwatermark(self, key, fetchid):
+        ''' Atomically save the id of the last exported fetch for the given
+            tradables key
+        '''
+        watermarks = self.getwatermarks()
+        watermarks[key] = fetchid
+        temp = self.watermarkpath + '.tmp'
+        with open(temp, 'w') as file:
+            json.dump(watermarks, file, indent=2)
+        os.replace(temp, self.watermarkpath)
+
+    def export(self, incremental=True, tradables=None):
+        ''' Export every fetch (newer than the watermark, if `incremental`) of
+            the given tradable names (or all tradables) to Parquet
+        '''
+        if pa is None:
+            raise ImportError('Exporting to Parquet requires pyarrow (pip install pyarrow)')
+
+        start = time.time()
+        os.makedirs(self.folder, exist_ok=True)
+        key = ','.join(sorted(tradables)) if tradables else '*'
+        since = self.getwatermark(key) if incremental else 0
+        cutoff = datetime.datetime.now() - datetime.timedelta(minutes=self.lag)
+        until, = db_config.session.execute(
+            text('SELECT MAX(id) FROM options_fetch WHERE time < :cutoff'),
+            {'cutoff': cutoff},
+        ).first()
+        db_config.session.rollback()
+        if until is None or until <= since:
+            log.info('No New Options Fetches To Export')
+            return 0
+
+        types = {
+            'int64': pa.int64(),
+            'timestamp': pa.timestamp('us'),
+            'string': pa.string(),
+            'float64': pa.float64(),
+            'date32': pa.date32(),
+            'bool': pa.bool_(),
+        }
+        schema = pa.schema([(name, types[kind]) for name, kind in COLUMNS])
+
+        # Partial (delta-encoded) fetches are rebuilt from the latest rows of
+        # their unchanged options, so start streaming from the earliest of
+        # their keyframes:
+        names = dict(db_config.session.query(Tradable.id, Tradable.name))
+        if tradables:
+            names = {id: name for id, name in names.items() if name in tradables}
+        partials = db_config.session.query(OptionsFetch).filter(
+            OptionsFetch.id > since,
+            OptionsFetch.id <= until,
+            OptionsFetch.keyframe_id != None,
+        )
+        if tradables:
+            partials = partials.filter(OptionsFetch.tradable_id.in_(list(names)))
+        partials = partials.order_by(OptionsFetch.id).all()
+        first = min([since] + [fetch.keyframe_id - 1 for fetch in partials])
+
+        columns = [name for name, _ in COLUMNS]
+        loaded = ['tradable_id'] + columns + [column for column in RECONSTRUCT if column not in columns]
+        filters = [OptionData.fetch_id > first, OptionData.fetch_id <= until]
+        if tradables:
+            filters.append(Option.tradable_id.in_(list(names)))
+        statement = query(loaded, *filters).order_by(OptionData.fetch_id).statement
+
+        log.info('Exporting Options Fetches %s to %s (%s Partial)...' % (since + 1, until, len(partials)))
+        count = 0
+        if not incremental:
+            self.staging = tempfile.mkdtemp(prefix='_staging-', dir=self.folder)
+        try:
+            batches = (
+                torecords(rows, loaded)
+                for rows in db_config.streambatches(statement, batchsize=self.batchsize)
+            )
+            for records in reconstruct(batches, partials, first=since + 1):
+                self.write(records, names, schema)
+                count += len(records)
+                log.info('Exported %s Rows...' % count)
+            self.close()
+            if self.staging is not None:
+                self.swap()
+        finally:
+            self.close()
+            if self.staging is not None:
+                shutil.rmtree(self.staging, ignore_errors=True)
+                self.staging = None
+
+        self.setwatermark(key, until)
+        log.info('Finished Exporting %s Rows In %.2fs' % (count, time.time() - start))
+        return count
+
+    def close(self):
+        ''' Close every open Parquet file
+        '''
+        for _, writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+    def swap(self):
+        ''' Replace every partition folder written by a full export with its
+            staged copy
+        '''
+        for tradable in os.listdir(self.staging):
+            for date in os.listdir(os.path.join(self.staging, tradable)):
+                folder = os.path.join(self.folder, tradable, date)
+                if os.path.exists(folder):
+                    shutil.rmtree(folder)
+                os.makedirs(os.path.dirname(folder), exist_ok=True)
+                os.replace(os.path.join(self.staging, tradable, date), folder)
+                log.info('Replaced Partition %s' % folder)
+
+    def write(self, records, names, schema):
+        ''' Write a batch of records to their (tradable, date) partition files,
+            given the { tradable id -> name } of every tradable
+        '''
+        dates = records['time'].astype('datetime64[D]')
+        for tradableid, date in sorted(set(zip(records['tradable_id'].tolist(), dates.tolist()))):
+            values = records[(records['tradable_id'] == tradableid) & (dates == np.datetime64(date))]
+            name = names[tradableid]
+            current, writer = self.writers.get(name, (None, None))
+            if current != date:
+                # Rows come in fetch order, so a tradable's earlier dates are
+                # complete once it moves on; only one file per tradable is open:
+                if writer is not None:
+                    writer.close()
+                folder = os.path.join(self.staging or self.folder, 'tradable=%s' % name, 'date=%s' % date)
+                os.makedirs(folder, exist_ok=True)
+                path = os.path.join(folder, 'part-%010d.parquet' % values['fetch_id'][0])
+                writer = pq.ParquetWriter(path, schema)
+                self.writers[name] = (date, writer)
+
+            table = pa.Table.from_arrays(
+                [pa.array(values[field.name], type=field.type, from_pandas=True) for field in schema],
+                schema=schema,
+            )
+            writer.write_table(table)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export options_data to partitioned Parquet files')
+    parser.add_argument('folder', help='Output folder')
+    parser.add_argument('--full', action='store_true', help='Export all fetches, ignoring the watermark')
+    parser.add_argument('--tradable', action='append', help='Only export the given tradable(s)')
+    parser.add_argument('--batch', type=int, default=50000, help='Rows per server-side cursor batch')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    exporter = ParquetExporter(args.folder, batchsize=args.batch)
+    exporter.export(incremental=not args.full, tradables=args.tradable)
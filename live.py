@@ -0,0 +1,137 @@
+import time
+import logging
+import threading
+
+log = logging.getLogger('td.live')
+
+# The quote fields kept for every contract, as { name -> OptionData column }:
+FIELDS = {
+    'bid': 'bid',
+    'ask': 'ask',
+    'mark': 'mark',
+    'iv': 'volatility',
+    'delta': 'delta',
+    'gamma': 'gamma',
+    'theta': 'theta',
+    'vega': 'vega',
+    'rho': 'rho',
+    'volume': 'volume',
+    'openinterest': 'openinterest',
+    'dte': 'dte',
+}
+
+class LiveSurface(object):
+    ''' In-Memory Options Surface of a Tradable, holding the latest quote (IV,
+        greeks & spread) of every call & put keyed by expiration & strike. The
+        surface is updated in place by OptionsDataClient on every fetch, so the
+        current surface can be read without querying the database. Surfaces
+        are shared per tradable, and are safe to read while being updated
+    '''
+    surfaces = {}
+    lock = threading.Lock()
+
+    def __init__(self, tradableid):
+        self.tradableid = tradableid
+        self.quotes = {'CALL': {}, 'PUT': {}}
+        self.underlying = None
+        self.riskfree = None
+        self.time = None
+        self.updated = None
+        self.rlock = threading.RLock()
+
+    @classmethod
+    def get(cls, tradableid):
+        ''' Get the shared surface of the given tradable id
+        '''
+        with cls.lock:
+            if tradableid not in cls.surfaces:
+                cls.surfaces[tradableid] = cls(tradableid)
+            return cls.surfaces[tradableid]
+
+    def update(self, contracts, underlying, riskfree, fetchtime):
+        ''' Update the surface with the given (Option columns, OptionData
+            columns) contracts of a fetch. Contracts missing from the fetch
+            (expired or delisted) are dropped from the surface
+        '''
+        start = time.time()
+        with self.rlock:
+            seen = {ctype: set() for ctype in self.quotes}
+            for option, data in contracts:
+                ctype = option['type']
+                key = (option['expiration'], option['strike'])
+                quote = {name: data[column] for name, column in FIELDS.items()}
+                bid, ask = quote['bid'], quote['ask']
+                quote['spread'] = ask - bid if bid is not None and ask is not None else None
+
+                strikes = self.quotes[ctype].setdefault(key[0], {})
+                if key[1] in strikes:
+                    strikes[key[1]].update(quote)
+                else:
+                    strikes[key[1]] = quote
+                seen[ctype].add(key)
+
+            # Drop the contracts that weren't in this fetch:
+            for ctype, expirations in self.quotes.items():
+                for expiration in list(expirations):
+                    strikes = expirations[expiration]
+                    for strike in [strike for strike in strikes if (expiration, strike) not in seen[ctype]]:
+                        del strikes[strike]
+                    if not strikes:
+                        del expirations[expiration]
+
+            self.underlying = underlying
+            self.riskfree = riskfree
+            self.time = fetchtime
+            self.updated = time.time()
+        log.debug('Updated Live Surface Of Tradable %s In %.4fs' % (self.tradableid, time.time() - start))
+
+    @property
+    def age(self):
+        ''' Get the number of seconds since the surface was last updated
+        '''
+        return time.time() - self.updated if self.updated is not None else None
+
+    def expirations(self, ctype='CALL'):
+        ''' Get the sorted expiration dates on the surface
+        '''
+        with self.rlock:
+            return sorted(self.quotes[ctype])
+
+    def quote(self, ctype, expiration, strike):
+        ''' Get a copy of the latest quote of the given contract, or None
+        '''
+        with self.rlock:
+            quote = self.quotes[ctype].get(expiration, {}).get(strike)
+            return dict(quote) if quote is not None else None
+
+    def smile(self, ctype, expiration):
+        ''' Get the (strike, quote) of every contract of the given expiration,
+            sorted by strike
+        '''
+        with self.rlock:
+            strikes = self.quotes[ctype].get(expiration, {})
+            return [(strike, dict(strikes[strike])) for strike in sorted(strikes)]
+
+    def atm(self, ctype, expiration):
+        ''' Get the (strike, quote) of the contract of the given expiration with
+            the strike closest to the underlying price, or None
+        '''
+        with self.rlock:
+            strikes = self.quotes[ctype].get(expiration)
+            if not strikes or self.underlying is None:
+                return None
+            strike = min(strikes, key=lambda strike: abs(strike - self.underlying))
+            return strike, dict(strikes[strike])
+
+    def snapshot(self):
+        ''' Get a copy of the whole surface, as
+            { type -> { expiration -> { strike -> quote } } }
+        '''
+        with self.rlock:
+            return {
+                ctype: {
+                    expiration: {strike: dict(quote) for strike, quote in strikes.items()}
+                    for expiration, strikes in expirations.items()
+                }
+                for ctype, expirations in self.quotes.items()
+            }
@@ -1,43 +1,112 @@
 import os
+import sys
 import time
 import logging
 import datetime
 import traceback
-from td.client import TDClient
+import multiprocessing
+import numpy as np
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert
+from td.client import TDClient, ChainStream
+from td.live import LiveSurface
 from td.research.implied import VIXImplied
 from td.database.models import *
 from td.database.config import db_config
+from td.database.bulk import OptionDataWriter
+from td.database.chains import loadfetches
+from td.database.optionids import cache as optioncache
 
 log = logging.getLogger('td.options')
 
+# The OptionData columns compared between fetches in delta mode:
+DELTAFIELDS = [
+    'ask', 'asksize', 'bid', 'bidsize', 'close', 'dte', 'delta', 'gamma', 'low',
+    'high', 'itm', 'last', 'lastsize', 'mark', 'markchange', 'rho', 'theovalue',
+    'theovol', 'theta', 'timevalue', 'volume', 'vega', 'volatility', 'openinterest',
+]
+
 class Helpers(object):
     @classmethod
-    def getoption(cls, tradable, expiration, type, description, symbol, exchange, expirationtype, strike):
-        ''' Get the given Option if it exists, else create a new Option instace
+    def contracts(cls, data, tradable):
+        ''' Iterate over the (date key, strike key, contract) of every Call, then
+            every Put, in a decoded options chain response
         '''
-        option = db_config.session.query(Option).filter_by(symbol=symbol).first()
-        if option:
-            return option
-        else:
-            option = Option(
-                tradable=tradable,
-                type=type,
-                description=description,
-                symbol=symbol,
-                exchange=exchange,
-                expirationtype=expirationtype,
-                strike=strike,
-                expiration=expiration,
-            )
-            return option
+        for calltype, datemap in [('Calls', data['callExpDateMap']), ('Puts', data['putExpDateMap'])]:
+            for datestr in sorted(datemap.keys()):
+                log.info('Parsing %s %s for: %s..' % (datestr.split(':')[0], calltype, tradable))
+                for strikestr in datemap[datestr]:
+                    yield datestr, strikestr, datemap[datestr][strikestr][0]
+
+    @classmethod
+    def getoptions(cls, tradable, options, chunksize=1000):
+        ''' Get the IDs of all of the given { symbol -> Option columns } Options
+            in bulk, inserting any Options that don't exist yet. Returns a
+            mapping of { symbol -> option id }
+        '''
+        # Options are read from the process-wide cache first:
+        optioncache.warm(tradable)
+        optionids, symbols = optioncache.lookup(options)
+
+        # Look up all of the other existing Options, a chunk of symbols at a time:
+        for i in range(0, len(symbols), chunksize):
+            chunk = symbols[i:i + chunksize]
+            query = db_config.session.query(Option.symbol, Option.id).filter(Option.symbol.in_(chunk))
+            optionids.update(query)
+
+        # Create all of the new Options with a single multi-row upsert:
+        rows = [dict(row, tradable_id=tradable.id) for symbol, row in options.items() if symbol not in optionids]
+        if rows:
+            log.info('Creating %s New Options For %s...' % (len(rows), tradable))
+            table = Option.__table__
+            statement = insert(table).values(rows)
+            statement = statement.on_conflict_do_nothing(index_elements=['symbol'])
+            statement = statement.returning(table.c.symbol, table.c.id)
+            optionids.update(db_config.session.execute(statement).fetchall())
+
+            # Options inserted concurrently by another writer aren't returned:
+            conflicts = [row['symbol'] for row in rows if row['symbol'] not in optionids]
+            if conflicts:
+                query = db_config.session.query(Option.symbol, Option.id).filter(Option.symbol.in_(conflicts))
+                optionids.update(query)
+
+        return optionids
+
+    @classmethod
+    def getiv(cls, chain):
+        ''' Compute the implied volatility of a (fetch id, arrays) chain, or None
+            if the chain doesn't have the expirations needed
+        '''
+        fetchid, arrays = chain
+        try:
+            return fetchid, VIXImplied.ivforchain(*arrays)
+        except Exception:
+            log.info('Could Not Compute Implied Vol For %s' % fetchid)
+            return fetchid, None
 
 class OptionsDataClient(object):
-    def __init__(self):
-        ''' Client for Repeatedly Fetching & Storing Options Chain Data
+    def __init__(self, copy=True, stream=False, delta=False, keyframe=30, live=False):
+        ''' Client for Repeatedly Fetching & Storing Options Chain Data. With
+            `stream`, chains are parsed incrementally as they are downloaded
+            (requires ijson), rather than decoded whole into memory first.
+
+            With `delta`, each fetch only stores the rows of the contracts that
+            changed since the tradable's previous fetch (kept in memory), and
+            every `keyframe` fetches a full snapshot is stored again. Partial
+            fetches are reconstructed by the td.database.chains loaders.
+
+            With `live`, every fetch also updates the tradable's in-memory
+            td.live.LiveSurface
         '''
+        self.stream = stream
+        self.delta = delta
+        self.keyframe = keyframe
+        self.live = live
+        self.snapshots = {}
         self.clientid = os.environ.get('TDCLIENTID')
         self.token = Token.current().token
         self.tdclient = TDClient(self.token, self.clientid)
+        self.writer = OptionDataWriter(copy=copy)
 
     def authenticate(self):
         ''' Refresh the TD API Session
@@ -53,16 +122,10 @@ class OptionsDataClient(object):
         '''
         '''
         try:
-            # Make sure the session is still valid:
-            if not self.isauthenticated():
-                self.authenticate()
-
             start = time.time()
             # Query the TD API:
-            tradable = db_config.session.query(Tradable).filter_by(name=name).first()
-            response = self.tdclient.optionschain(tradable.name)
-
-            self._parse(response, tradable)
+            response = self.download(name)
+            tradable = self.store(name, response)
 
             log.info('Finished Fetching %s Options Data In %.2fs' % (tradable, time.time() - start))
         except:
@@ -70,93 +133,148 @@ class OptionsDataClient(object):
             log.error(traceback.format_exc())
             db_config.session.rollback()
 
+    def download(self, name):
+        ''' Query the TD API for the full options chain of the given tradable
+        '''
+        if self.stream:
+            return self.tdclient.streamoptionschain(name)
+        return self.tdclient.optionschain(name)
+
+    def store(self, name, response):
+        ''' Parse & save a downloaded options chain for the given tradable name
+        '''
+        tradable = db_config.session.query(Tradable).filter_by(name=name).first()
+        if isinstance(response, ChainStream):
+            self._ingest(response.meta, response, tradable)
+        else:
+            self._parse(response, tradable)
+        return tradable
 
     def _parse(self, data, tradable):
         ''' Parse the options chain data and insert in into the Database
         '''
+        self._ingest(data, Helpers.contracts(data, tradable), tradable)
 
-        # Gather some constant values:
-        riskfree = data['interestRate']
-        underlying = data['underlyingPrice']
+    def _ingest(self, meta, contracts, tradable):
+        ''' Insert the given (date key, strike key, contract) options chain
+            contracts into the Database. Each contract is reduced to its Option
+            & OptionData columns as soon as it is read, so `contracts` can be a
+            stream; the chain-wide values are read from `meta` once it's consumed
+        '''
         now = datetime.datetime.now()
 
-        # Parse the Calls and Puts in the Response:
-        calls = data['callExpDateMap']
-        puts = data['putExpDateMap']
+        # Reduce Each Contract to its Option & OptionData Columns:
+        options = {}
+        alloptionsdata = []
+        volume = 0
+        openinterest = 0
+        for datestr, strikestr, data in contracts:
+            symbol = data['symbol']
+            if symbol not in options:
+                options[symbol] = {
+                    'type': data['putCall'],
+                    'description': data['description'],
+                    'symbol': symbol,
+                    'exchange': data['exchangeName'],
+                    'expirationtype': data['expirationType'],
+                    'strike': float(strikestr),
+                    'expiration': datetime.datetime.strptime(datestr.split(':')[0], '%Y-%m-%d').date(),
+                }
+
+            # Keep running totals of the fetch's volume & open interest:
+            volume += data['totalVolume'] or 0
+            openinterest += data['openInterest'] or 0
+
+            # Create a new OptionsData row:
+            alloptionsdata.append({
+                'ask': data['ask'],
+                'asksize': data['askSize'],
+                'bid': data['bid'],
+                'bidsize': data['bidSize'],
+                'close': data['closePrice'],
+                'dte': data['daysToExpiration'],
+                'delta': data['delta'],
+                'gamma': data['gamma'],
+                'low': data['lowPrice'],
+                'high': data['highPrice'],
+                'itm': data['inTheMoney'],
+                'last': data['last'],
+                'lastsize': data['lastSize'],
+                'mark': data['mark'],
+                'markchange': data['markChange'],
+                'rho': data['rho'],
+                'theovalue': data['theoreticalOptionValue'],
+                'theovol': data['theoreticalVolatility'],
+                'theta': data['theta'],
+                'timevalue': data['timeValue'],
+                'volume': data['totalVolume'],
+                'vega': data['vega'],
+                'volatility': data['volatility'],
+                'option_id': symbol,
+                'openinterest': data['openInterest'],
+            })
+
+        # Gather some constant values:
+        riskfree = meta['interestRate']
+        underlying = meta['underlyingPrice']
+
+        # Resolve (or Create) All of the Options in a Single Batch:
+        optionids = Helpers.getoptions(tradable, options)
 
         # Create an OptionsFetch wrapper for this fetch:
-        fetch = OptionsFetch(tradable=tradable, time=now)
+        fetch = OptionsFetch(tradable=tradable, time=now, underlying=underlying, riskfree=riskfree)
+        fetch.volume = int(volume)
+        fetch.oi = int(openinterest)
 
-        # Loop Through The Entire Options Chain:
-        alloptions = []
-        alloptionsdata = []
-        for datemap, calltype in [(calls, 'Calls'), (puts, 'Puts')]:
-            dates = datemap.keys()
-            for datestr in sorted(dates):
-                # Parse the Date String into a datetime object:
-                expdate, _ = datestr.split(':')
-                expiration = datetime.datetime.strptime(expdate, '%Y-%m-%d').date()
+        # Pair up every row with its Option, to update the live surface:
+        if self.live:
+            contracts = [(options[row['option_id']], row) for row in alloptionsdata]
 
-                log.info('Parsing %s %s for: %s..' % (expdate, calltype, tradable))
+        for row in alloptionsdata:
+            row['option_id'] = optionids[row['option_id']]
 
-                # Loop Through All Strike Prices for the given expiration Date:
-                for strikestr in datemap[datestr]:
-                    # Get this Options Data:
-                    strike = float(strikestr)
-                    data = datemap[datestr][strikestr][0]
-
-                    # Get or Create the Option:
-                    option = Helpers.getoption(
-                        tradable=tradable,
-                        expiration=expiration,
-                        type=data['putCall'],
-                        description=data['description'],
-                        symbol=data['symbol'],
-                        exchange=data['exchangeName'],
-                        expirationtype=data['expirationType'],
-                        strike=strike,
-                    )
-                    # Create & Save a new OptionsData row instance:
-                    optiondata = OptionData(
-                        ask=data['ask'],
-                        asksize=data['askSize'],
-                        bid=data['bid'],
-                        bidsize=data['bidSize'],
-                        close=data['closePrice'],
-                        dte=data['daysToExpiration'],
-                        delta=data['delta'],
-                        gamma=data['gamma'],
-                        low=data['lowPrice'],
-                        high=data['highPrice'],
-                        itm=data['inTheMoney'],
-                        last=data['last'],
-                        lastsize=data['lastSize'],
-                        mark=data['mark'],
-                        markchange=data['markChange'],
-                        rho=data['rho'],
-                        theovalue=data['theoreticalOptionValue'],
-                        theovol=data['theoreticalVolatility'],
-                        theta=data['theta'],
-                        timevalue=data['timeValue'],
-                        volume=data['totalVolume'],
-                        vega=data['vega'],
-                        volatility=data['volatility'],
-                        option=option,
-                        time=now,
-                        riskfree=riskfree,
-                        underlying=underlying,
-                        openinterest=data['openInterest'],
-                        fetch=fetch
-                    )
-                    alloptions.append(option)
-                    alloptionsdata.append(optiondata)
+        # In delta mode, only keep the rows that changed since the last fetch:
+        if self.delta:
+            snapshot = {row['option_id']: tuple(row[field] for field in DELTAFIELDS) for row in alloptionsdata}
+            previous = self.snapshots.get(tradable.id)
+            if previous is not None and previous['count'] < self.keyframe:
+                changed = [row for row in alloptionsdata if previous['values'].get(row['option_id']) != snapshot[row['option_id']]]
+                fetch.keyframe_id = previous['keyframe']
+                fetch.unchanged = list(set(snapshot) - set(row['option_id'] for row in changed))
+                log.info('%s of %s %s Options Are Unchanged...' % (len(fetch.unchanged), len(snapshot), tradable))
+                alloptionsdata = changed
+
+        # Save the OptionsFetch first, so its ID is available to the rows:
+        db_config.session.add(fetch)
+        db_config.session.flush()
+
+        for row in alloptionsdata:
+            row['time'] = now
+            row['riskfree'] = riskfree
+            row['underlying'] = underlying
+            row['fetch_id'] = fetch.id
 
         log.info('Saving %s New Options Data Instances For %s...' % (len(alloptionsdata), tradable))
-        db_config.session.add_all(alloptions)
-        db_config.session.add_all(alloptionsdata)
+        self.writer.write(alloptionsdata)
         db_config.session.commit()
         log.info('Saving Complete (%s)' % datetime.datetime.now())
 
+        # Remember the snapshot as soon as it's committed, before anything else
+        # can fail, so the next fetch is never diffed against an older one:
+        if self.delta:
+            if fetch.keyframe_id is None:
+                self.snapshots[tradable.id] = {'keyframe': fetch.id, 'count': 1, 'values': snapshot}
+            else:
+                self.snapshots[tradable.id] = {'keyframe': fetch.keyframe_id, 'count': previous['count'] + 1, 'values': snapshot}
+
+        # Cache the ids of the Options seen for the first time, now that
+        # they're committed:
+        _, missing = optioncache.lookup(options)
+        optioncache.update([(symbol, optionids[symbol], options[symbol]['expiration']) for symbol in missing])
+
+        if self.live:
+            LiveSurface.get(tradable.id).update(contracts, underlying, riskfree, now)
+
     @classmethod
     def ismarketopen(cls):
         ''' Determine if the market is open
@@ -174,39 +292,116 @@ class OptionsDataClient(object):
     @classmethod
     def updatevols(cls):
         ''' Update the values of OptionsFetch volatility, oi, volume columns
+            for the options fetches from the past five days
         '''
-        # Get the IDs of the all options fetches from the past five days:
-        now = datetime.datetime.now()
-        days = 5
-        cutoff = now - datetime.timedelta(days=days)
-        query = db_config.session.query(OptionsFetch.id).filter(OptionsFetch.time > cutoff).all()
-        ids = [id for id, in query]
-        log.info('Updating %s Options Fetches From the last %s Days...' % (len(ids), days))
-
-        # Update Each Fetch:
-        for id in ids:
-            fetch = db_config.session.query(OptionsFetch).get(id)
-
-            # Implied Volatility:
-            if fetch.volatility is None:
-                try:
-                    log.info('Loading Implied Vol For %s...' % fetch.id)
-                    fetch.volatility = VIXImplied.getiv(fetch)
-                except:
-                    db_config.session.rollback()
-            # Volume:
-            if fetch.volume is None:
-                log.info('Loading Volume For %s...' % fetch.id)
-                fetch.volume = VIXImplied.volume(fetch)
-
-            # Open Interest:
-            if fetch.oi is None:
-                log.info('Loading Open Interest For %s...' % fetch.id)
-                fetch.oi = VIXImplied.openinterest(fetch)
-
-            # Save all changes:
-            db_config.session.commit()
+        cls.backfill(days=5)
+
+    @classmethod
+    def backfill(cls, days=None, processes=None, recompute=False, chunksize=250):
+        ''' Fill in the volatility, oi, volume columns of every pending
+            OptionsFetch (from the past `days` days, if given), or of every
+            fetch if `recompute` is set. Pending fetches are processed
+            `chunksize` fetches at a time, so memory use stays bounded however
+            much history is pending: each chunk's chains are loaded with one
+            columnar query, their implied vols are computed in a single pass
+            (across a pool of `processes` processes, if given), and the results
+            are saved in one bulk UPDATE
+        '''
+        start = time.time()
+        query = db_config.session.query(
+            OptionsFetch.id,
+            OptionsFetch.time,
+            OptionsFetch.volatility,
+            OptionsFetch.volume,
+            OptionsFetch.oi,
+        )
+        if not recompute:
+            query = query.filter(or_(
+                OptionsFetch.volatility == None,
+                OptionsFetch.volume == None,
+                OptionsFetch.oi == None,
+            ))
+        if days is not None:
+            cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+            query = query.filter(OptionsFetch.time > cutoff)
+        pending = {id: (fetchtime, volatility, volume, oi) for id, fetchtime, volatility, volume, oi in query.order_by(OptionsFetch.id)}
+        if recompute:
+            pending = {id: (fetchtime, None, None, None) for id, (fetchtime, _, _, _) in pending.items()}
+        log.info('Backfilling %s Pending Options Fetches...' % len(pending))
+        if not pending:
+            return
+
+        pool = multiprocessing.Pool(processes) if processes else None
+        count = 0
+        try:
+            ids = list(pending)
+            for i in range(0, len(ids), chunksize):
+                chunk = {id: pending[id] for id in ids[i:i + chunksize]}
+                count += cls.backfillchunk(chunk, pool)
+                log.info('Backfilled %s of %s Options Fetches...' % (min(i + chunksize, len(ids)), len(ids)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        log.info('Finished Backfilling %s Options Fetches In %.2fs' % (count, time.time() - start))
+
+    @classmethod
+    def backfillchunk(cls, pending, pool=None):
+        ''' Backfill the given { fetch id -> (time, volatility, volume, oi) }
+            chunk of pending fetches, returning the number of fetches updated
+        '''
+        updates = {id: {'id': id} for id in pending}
+
+        # Volume & Open Interest, totalled for the whole chunk in one query:
+        totals = OptionsFetch.totals(list(pending))
+        for id, (_, volatility, volume, oi) in pending.items():
+            total = totals.get(id, (0, 0))
+            if volume is None:
+                updates[id]['volume'] = total[0]
+            if oi is None:
+                updates[id]['oi'] = total[1]
+
+        # Implied Volatility, from a single columnar query of the chunk's chains:
+        ids = [id for id, (_, volatility, _, _) in pending.items() if volatility is None]
+        if ids:
+            columns = ['dte', 'type', 'strike', 'bid', 'theovalue', 'riskfree']
+            times = [pending[id][0] for id in ids if pending[id][0] is not None]
+            chain = loadfetches(ids, columns=columns, since=min(times) if times else None)
+            arrays = [
+                chain['dte'],
+                chain['type'] == 'CALL',
+                chain['strike'],
+                chain['bid'],
+                chain['theovalue'],
+                chain['riskfree'],
+            ]
+
+            # Split the rows (sorted by fetch id) into one chain per fetch:
+            chains = []
+            fetchids = chain['fetch_id']
+            bounds = np.flatnonzero(np.diff(fetchids)) + 1
+            for group in np.split(np.arange(len(fetchids)), bounds):
+                if len(group):
+                    chains.append((int(fetchids[group[0]]), [array[group] for array in arrays]))
+
+            if pool is not None:
+                results = pool.map(Helpers.getiv, chains, chunksize=16)
+            else:
+                results = map(Helpers.getiv, chains)
+            for id, volatility in results:
+                if volatility is not None:
+                    updates[id]['volatility'] = volatility
+
+        # Save the chunk's changes in one bulk UPDATE:
+        updates = [update for update in updates.values() if len(update) > 1]
+        db_config.session.bulk_update_mappings(OptionsFetch, updates)
+        db_config.session.commit()
+        return len(updates)
 
 if __name__ == '__main__':
-    client = OptionsDataClient()
-    client.fetch('SPY')
+    if (len(sys.argv) > 1) and (sys.argv[1] == '--backfill'):
+        # Backfill (or with --recompute, Recompute) All Options Fetches Across Every Core:
+        OptionsDataClient.backfill(processes=multiprocessing.cpu_count(), recompute='--recompute' in sys.argv)
+    else:
+        client = OptionsDataClient()
+        client.fetch('SPY')
@@ -4,126 +4,117 @@ import time
 import logging
 import datetime
 import traceback
-
-
-class PutCall(object):
-    def __init__(self, put, call):
-        assert put.option.strike == call.option.strike
-        self.put = put
-        self.call = call
-
-        self.strike = float(self.put.option.strike)
-        self.putmid = float(self.put.theovalue)
-        self.callmid = float(self.call.theovalue)
-        self.difference = abs(self.callmid - self.putmid)
-
-        self.putBid = float(self.put.bid)
-        self.putAsk = float(self.put.ask)
-        self.callBid = float(self.call.bid)
-        self.callAsk = float(self.call.ask)
+import numpy as np
+from td.database.models import OptionsFetch
+from td.database.chains import loadfetch
 
 
 class Helpers(object):
     @classmethod
-    def volforladder(cls, dte, surface):
-        ''' Get the near-term and next-term volatility for the surface's options
-            that have the given DTE
+    def ladder(cls, dte, dtes, iscall, strikes, bids, mids):
+        ''' Get the strikes, put & call bids, and put & call mids of the
+            options that have the given DTE, as arrays of equal-striked pairs
         '''
-        # Filter out Options to only use
-        options = filter(lambda o: o.dte == dte, surface)
-
-        # Use the risk free rate of the first option:
-        rfree = float(options[0].riskfree)
-        minutes = float(dte) * 60. * 24. / 525600.
-
-        #
-        puts = filter(lambda o: o.option.type == 'PUT', options)
-        calls = filter(lambda o: o.option.type == 'CALL', options)
-        puts.sort(key=lambda x: x.option.strike)
-        calls.sort(key=lambda x: x.option.strike)
+        atdte = dtes == dte
+        puts = np.flatnonzero(atdte & ~iscall)
+        calls = np.flatnonzero(atdte & iscall)
+        puts = puts[np.argsort(strikes[puts], kind='stable')]
+        calls = calls[np.argsort(strikes[calls], kind='stable')]
 
         assert len(puts) == len(calls)
+        assert (strikes[puts] == strikes[calls]).all()
+
+        return strikes[puts], bids[puts], bids[calls], mids[puts], mids[calls]
 
-        # Zip all equal striked calls and puts into PutCalls objects:
-        options = [PutCall(puts[i], calls[i]) for i in range(len(puts))]
+    @classmethod
+    def volforladder(cls, dte, rfree, strikes, putbids, callbids, putmids, callmids):
+        ''' Get the near-term and next-term volatility for the given DTE's
+            ladder of equal-striked put/call pairs (sorted by strike)
+        '''
+        minutes = float(dte) * 60. * 24. / 525600.
 
         # Get forward price:
-        foption = min(options, key=lambda x: x.difference)
-        forward = foption.strike + math.exp(minutes * rfree) * (foption.callmid - foption.putmid)
+        findex = np.argmin(np.abs(callmids - putmids))
+        forward = strikes[findex] + math.exp(minutes * rfree) * (callmids[findex] - putmids[findex])
 
         # Find the pivot strike price:
-        k0 = max(o.strike for o in options if o.strike < forward)
+        k0 = strikes[strikes < forward].max()
 
         # Get all calls and puts above and below k0, repectively:
-        puts = filter(lambda o: o.strike <= k0, options)
-        calls = filter(lambda o: o.strike >= k0, options)
-        puts.sort(key=lambda o: o.strike, reverse=True)
-        calls.sort(key=lambda o: o.strike)
+        puts = np.flatnonzero(strikes <= k0)
+        calls = np.flatnonzero(strikes >= k0)
+        puts = puts[np.argsort(-strikes[puts], kind='stable')]
+        calls = calls[np.argsort(strikes[calls], kind='stable')]
 
         # Filter out calls & puts with zero bids:
-        puts = cls.filterbybid(puts, put=True)
-        calls = cls.filterbybid(calls, put=False)
-
+        puts = puts[cls.filterbybid(putbids[puts])]
+        calls = calls[cls.filterbybid(callbids[calls])]
 
         # Take a weighted sum across the filtered set of calls and puts:
+        pstrikes, pmids = strikes[puts], putmids[puts]
+        cstrikes, cmids = strikes[calls], callmids[calls]
         wsum = 0.
-        for i, put in enumerate(puts[1:-1]):
-            delta = (puts[i].strike - puts[i + 2].strike) / 2.
-            wsum += delta * put.putmid / (put.strike ** 2)
-
-        for i, call in enumerate(calls[1:-1]):
-            delta = (calls[i + 2].strike - calls[i].strike) / 2.
-            wsum += delta * call.callmid / (call.strike ** 2)
+        wsum += ((pstrikes[:-2] - pstrikes[2:]) / 2. * pmids[1:-1] / pstrikes[1:-1] ** 2).sum()
+        wsum += ((cstrikes[2:] - cstrikes[:-2]) / 2. * cmids[1:-1] / cstrikes[1:-1] ** 2).sum()
 
         # Add in border put:
-        bput = puts[-1]
-        delta = puts[-2].strike - bput.strike
-        wsum += delta * bput.putmid / (bput.strike ** 2)
+        wsum += (pstrikes[-2] - pstrikes[-1]) * pmids[-1] / (pstrikes[-1] ** 2)
         # Add in border call:
-        bcall = calls[-1]
-        delta = bcall.strike - calls[-2].strike
-        wsum += delta * bcall.callmid / (bcall.strike ** 2)
+        wsum += (cstrikes[-1] - cstrikes[-2]) * cmids[-1] / (cstrikes[-1] ** 2)
 
         # Add in averaged pivot put/call option:
-        midoption = puts[0]
-        midprice = (midoption.callmid + midoption.putmid) / 2.
-        delta = (calls[1].strike - puts[1].strike) / 2.
-        wsum += delta * midprice / midoption.strike ** 2
+        mid = puts[0]
+        midprice = (callmids[mid] + putmids[mid]) / 2.
+        delta = (cstrikes[1] - pstrikes[1]) / 2.
+        wsum += delta * midprice / strikes[mid] ** 2
 
         # Do one final computation to get the vol metric for this level:
         vol = (2. / minutes) * wsum * math.exp(minutes * rfree) - (forward / k0 - 1) ** 2 / minutes
-        return minutes, vol
+        return minutes, float(vol)
 
     @classmethod
-    def filterbybid(cls, options, put=True):
-        ''' Filter the sorted options as follows:
+    def filterbybid(cls, bids):
+        ''' Get the indices of the (sorted) bids to keep, as follows:
                 - If bid is zero, skip
                 - If two consecutive zero bids are found, terminate
         '''
-        consecutive = 0
-        filtered = []
-        for option in options:
-            bid = option.putBid if put else option.callBid
-            if bid == 0.:
-                consecutive += 1
-                if consecutive == 2:
-                    break
-            else:
-                filtered.append(option)
-                consecutive = 0
-        return filtered
+        zeros = bids == 0.
+        pairs = np.flatnonzero(zeros[1:] & zeros[:-1])
+        stop = pairs[0] + 1 if len(pairs) else len(bids)
+        return np.flatnonzero(~zeros[:stop])
 
 class VIXImplied(object):
     @classmethod
     def getiv(cls, fetch):
         ''' Get the most recent options surface for the given tradable symbol
         '''
-        surface = fetch.values
-        dtes = set(item.dte for item in fetch.values)
-        neardte = min(i for i in dtes if i > 23)
-        nextdte = max(i for i in dtes if i < 37)
-        nearmin, nearvol = Helpers.volforladder(neardte, surface)
-        nextmin, nextvol = Helpers.volforladder(nextdte, surface)
+        chain = loadfetch(fetch, columns=['dte', 'type', 'strike', 'bid', 'theovalue', 'riskfree'])
+        return cls.ivforchain(
+            dtes=chain['dte'],
+            iscall=chain['type'] == 'CALL',
+            strikes=chain['strike'],
+            bids=chain['bid'],
+            mids=chain['theovalue'],
+            rfrees=chain['riskfree'],
+        )
+
+    @classmethod
+    def ivforchain(cls, dtes, iscall, strikes, bids, mids, rfrees):
+        ''' Compute the VIX-style 30-day implied volatility of an options chain,
+            given as equal-length arrays with one entry per contract
+        '''
+        neardte = dtes[dtes > 23].min()
+        nextdte = dtes[dtes < 37].max()
+        nearmin, nearvol = Helpers.volforladder(
+            neardte,
+            rfrees[dtes == neardte][0],
+            *Helpers.ladder(neardte, dtes, iscall, strikes, bids, mids)
+        )
+        nextmin, nextvol = Helpers.volforladder(
+            nextdte,
+            rfrees[dtes == nextdte][0],
+            *Helpers.ladder(nextdte, dtes, iscall, strikes, bids, mids)
+        )
 
         # Take the weighted average of the two ladders around 30 days:
         year = 525600.
@@ -138,10 +129,12 @@ class VIXImplied(object):
     def volume(cls, fetch):
         ''' Get total volume for the given options surface
         '''
-        return sum([option.volume for option in fetch.values if option.volume])
+        volume, _ = OptionsFetch.totals([fetch.id]).get(fetch.id, (0, 0))
+        return volume
 
     @classmethod
     def openinterest(cls, fetch):
         ''' Get total open interest for the given options surface
         '''
-        return sum([option.openinterest for option in fetch.values if option.openinterest])
+        _, oi = OptionsFetch.totals([fetch.id]).get(fetch.id, (0, 0))
+        return oi
@@ -1,8 +1,53 @@
 import time
 import datetime
 import traceback
-import matplotlib.pyplot as plt
-from db.models import Tradable, Option, OptionData, session
+from td.database.models import *
+from td.database.config import db_config
+from td.database.chains import loadchain
+from td.research.render import Painter, render
+
+session = db_config.session
+
+
+class OpenInterestPainter(Painter):
+    ''' Paints (dte, put OIs, call OIs, predictor) open interest frames over a
+        fixed set of strikes, reusing the same bars across frames
+    '''
+    def setup(self, strikes, underlying, ylim, callcolor, putcolor):
+        self.axes = self.figure.add_subplot(1, 1, 1)
+        zeros = [0] * len(strikes)
+        self.puts = self.axes.bar(strikes, zeros, label='Puts', color=putcolor, edgecolor=(0, 0, 0, 0))
+        self.calls = self.axes.bar(strikes, zeros, label='Calls', color=callcolor, edgecolor=(0, 0, 0, 0))
+
+        # Add a black vertical line where the current price is:
+        if underlying is not None:
+            self.axes.axvline(x=underlying, color='black', lw=1.75)
+        self.predictor = self.axes.axvline(x=underlying or strikes[0], color='purple', lw=1.75, visible=False)
+
+        # Use a standard yaxis limit:
+        self.ylim = ylim
+        if ylim:
+            self.axes.set_ylim([0, ylim])
+
+        self.axes.legend()
+        self.axes.set_ylabel('Open Interest')
+        self.title = self.axes.set_title('')
+
+    def draw(self, frame):
+        dte, putvals, callvals, oiestimator = frame
+        for bars, values in [(self.puts, putvals), (self.calls, callvals)]:
+            for bar, value in zip(bars, values):
+                bar.set_height(value)
+
+        # Show the open-interest-weighted predictor, if there is one:
+        if oiestimator:
+            self.predictor.set_xdata([oiestimator, oiestimator])
+        self.predictor.set_visible(bool(oiestimator))
+
+        if not self.ylim:
+            self.axes.relim()
+            self.axes.autoscale_view()
+        self.title.set_text('%s DTE' % dte)
 
 
 class OpenInterest(object):
@@ -16,50 +61,39 @@ class OpenInterest(object):
         self.callcolor = (1.0, 0, 0, 0.4)
         self.putcolor = (0, 0, 1.0, 0.4)
 
-    def plot(self, folder='ois/gif', minval=250, items=160, step=0.5, ylim=None):
-        ''' Plot self.chain
+    def plot(self, path='ois/oi.gif', minval=250, items=160, step=0.5, ylim=None, fps=4, processes=None):
+        ''' Plot self.chain, one expiration per frame, into an animated GIF (or,
+            for other extensions, a video)
         '''
         if ylim is None:
             ylim = max([max([max(t.values()) for t in v]) for v in [item.values() for item in self.chain.values()]])
 
-        dtes = sorted(self.chain.keys())
-        for index, dte in enumerate(dtes):
+        # strikes = sorted(list(set(puts.keys() + calls.keys())))
+        strikes = [minval + i * step for i in range(items)]
 
-            plt.figure(figsize=(16, 8))
+        frames = []
+        for dte in sorted(self.chain.keys()):
             expirationchain = self.chain[dte]
-            puts = expirationchain['PUT']
-            calls = expirationchain['CALL']
+            puts = expirationchain.get('PUT', {})
+            calls = expirationchain.get('CALL', {})
 
-            # Get Axis, Bar Values:
-            # strikes = sorted(list(set(puts.keys() + calls.keys())))
-            strikes = [minval + i * step for i in range(items)]
+            # Get Bar Values, and the open-interest-weighted predictor:
             putvals = [puts.get(strike, 0) for strike in strikes]
             callvals = [calls.get(strike, 0) for strike in strikes]
-
-            # Plot:
-            plt.bar(strikes, putvals, label='Puts', color=self.putcolor, edgecolor=(0, 0, 0, 0))
-            plt.bar(strikes, callvals, label='Calls', color=self.callcolor, edgecolor=(0, 0, 0, 0))
-
-            # Add a black vertical line where the current price is:
-            plt.axvline(x=self.underlying, color='black', lw=1.75)
-
-            # Attempt to compute and add the open-interest-weighted predictor:
-            oiestimator = self.oipredictor(expirationchain)
-            if oiestimator:
-                plt.axvline(x=oiestimator, color='purple', lw=1.75)
-
-            # Use a standard yaxis limit:
-            if ylim:
-                plt.ylim([0, ylim])
-
-
-            plt.legend()
-            plt.ylabel('Open Interest')
-            plt.title('%s DTE' % dte)
-            # plt.show()
-            filename = '%s/%s' % (folder, str(index).zfill(4))
-            plt.savefig(filename, edgecolor='black')
-            plt.close()
+            frames.append((dte, putvals, callvals, self.oipredictor(expirationchain)))
+
+        return render(
+            frames,
+            OpenInterestPainter,
+            path,
+            fps=fps,
+            processes=processes,
+            strikes=strikes,
+            underlying=self.underlying,
+            ylim=ylim,
+            callcolor=self.callcolor,
+            putcolor=self.putcolor,
+        )
 
 
     def oipredictor(self, chain):
@@ -67,14 +101,14 @@ class OpenInterest(object):
             following White Paper:
             https://www.researchgate.net/publication/305194232_Trading_on_the_information_content_of_open_interest_Evidence_from_the_US_equity_options_market
         '''
-        puts = chain['PUT']
-        calls = chain['CALL']
+        puts = chain.get('PUT', {})
+        calls = chain.get('CALL', {})
 
         callinterest = sum(calls.values())
         putinterest = sum(puts.values())
 
-        weightedcallinterests = sum([strike * oi for strike, oi in calls.iteritems()])
-        weightedputinterests = sum([strike * oi for strike, oi in puts.iteritems()])
+        weightedcallinterests = sum([strike * oi for strike, oi in calls.items()])
+        weightedputinterests = sum([strike * oi for strike, oi in puts.items()])
 
         if callinterest or putinterest:
             estimate = (weightedcallinterests + weightedputinterests) / (callinterest + putinterest)
@@ -91,41 +125,23 @@ class OpenInterest(object):
         '''
         start = time.time()
 
-        # Get All Option IDs for this Tradable:
-        print 'Fetching %s Options...' % self.tradable.name
-        query = session.execute("SELECT id FROM options WHERE tradable_id=%s;" % self.tradable.id)
-        optionids = [str(id) for (id,) in query]
-
-        # Get the Time of The Most Recent Options Data Query For this Tradable:
-        print 'Determining Most Recent Fetch Time...'
-        query = session.execute("SELECT MAX(time) FROM options_data WHERE option_id IN (%s);" % ', '.join(optionids))
-        mostrecent = list(query)[0][0]
-        print 'Most recent Fetch Was: %s' % mostrecent
-
-        # Get the options data ids for the most recent fetch:
-        print 'Fetching Most Recent Fetch Options Data IDs...'
-        query = session.execute("SELECT id FROM options_data WHERE time='%s';" % str(mostrecent))
-        dataids = [int(id) for (id,) in query]
-
-        # Get all the options Values:
-        print 'Collecting Options Data Records From Most Recent API Fetch...'
-        values = session.query(OptionData).filter(OptionData.id.in_(dataids)).all()
-
-        print 'Constructing Options Chain...'
+        print('Loading Most Recent %s Options Chain...' % self.tradable.name)
+        chain = loadchain(self.tradable, columns=['dte', 'type', 'strike', 'openinterest', 'underlying'])
 
+        print('Constructing Options Chain...')
         data = {}
-
-        underlying = None
-        for value in values:
-            underlying = float(value.underlying)
-            strike = float(value.option.strike)
-            oi = value.openinterest
-            dte = value.dte
+        for dte, otype, strike, oi in zip(
+            chain['dte'].tolist(),
+            chain['type'].tolist(),
+            chain['strike'].tolist(),
+            chain['openinterest'].tolist(),
+        ):
             data.setdefault(dte, {})
-            data[dte].setdefault(value.option.type, {})
-            data[dte][value.option.type][strike] = oi
+            data[dte].setdefault(otype, {})
+            data[dte][otype][strike] = oi
+        underlying = float(chain['underlying'][-1]) if len(chain) else None
 
-        print 'Finished Constructing Options Chain in %.2fs' % (time.time() - start,)
+        print('Finished Constructing Options Chain in %.2fs' % (time.time() - start,))
         return data, underlying
 
 if __name__ == '__main__':
@@ -0,0 +1,136 @@
+import sys
+import time
+import numpy as np
+from td.database.models import *
+from td.database.config import db_config
+from td.database.chains import iterfetches
+
+session = db_config.session
+
+# The chain columns needed for the analytics:
+COLUMNS = ['fetch_id', 'time', 'type', 'strike', 'expiration', 'dte', 'openinterest', 'underlying']
+
+# The computed analytics, one record per (fetch, expiration):
+DTYPE = [
+    ('fetch_id', 'i8'),
+    ('time', 'datetime64[us]'),
+    ('expiration', 'datetime64[D]'),
+    ('dte', 'i4'),
+    ('underlying', 'f8'),
+    ('calloi', 'i8'),
+    ('putoi', 'i8'),
+    ('pcratio', 'f8'),
+    ('predictor', 'f8'),
+    ('maxpain', 'f8'),
+]
+
+
+def groupsum(values, starts, lengths):
+    ''' Get the running sum of the given values within each contiguous group
+    '''
+    sums = np.cumsum(values)
+    return sums - np.repeat(sums[starts] - values[starts], lengths)
+
+
+def analyze(chain):
+    ''' Compute the open interest analytics of every (fetch, expiration) in the
+        given chain records (with all of the COLUMNS) in one batch:
+            - the open-interest-weighted strike predictor (see
+              td.research.oi.OpenInterest.oipredictor)
+            - the put/call open interest ratio
+            - the max pain strike: the strike at which the open contracts
+              would pay out the least at expiration
+        Groups without open interest get NaNs
+    '''
+    if not len(chain):
+        return np.empty(0, dtype=DTYPE)
+
+    # Sort into contiguous (fetch, expiration) groups, by strike:
+    chain = chain[np.lexsort((chain['strike'], chain['expiration'], chain['fetch_id']))]
+    fetchids, expirations = chain['fetch_id'], chain['expiration']
+    changes = (np.diff(fetchids) != 0) | (np.diff(expirations) != 0)
+    starts = np.concatenate([[0], np.flatnonzero(changes) + 1])
+    lengths = np.diff(np.concatenate([starts, [len(chain)]]))
+    groups = np.repeat(np.arange(len(starts)), lengths)
+
+    strikes = chain['strike']
+    iscall = chain['type'] == 'CALL'
+    oi = chain['openinterest'].astype(float)
+    calloi = np.where(iscall, oi, 0.)
+    putoi = np.where(iscall, 0., oi)
+
+    # Open interest totals & weighted predictor:
+    calls = np.add.reduceat(calloi, starts)
+    puts = np.add.reduceat(putoi, starts)
+    total = calls + puts
+    weighted = np.add.reduceat(oi * strikes, starts)
+
+    # Max pain, from running sums over the strikes of each group: at strike K,
+    # calls below K pay K * sum(oi) - sum(oi * strike), and puts above K pay
+    # sum(oi * strike) - K * sum(oi)
+    callpain = strikes * groupsum(calloi, starts, lengths) - groupsum(calloi * strikes, starts, lengths)
+    putstrikes = putoi * strikes
+    putpain = (
+        np.repeat(np.add.reduceat(putstrikes, starts), lengths) - groupsum(putstrikes, starts, lengths)
+    ) - strikes * (np.repeat(puts, lengths) - groupsum(putoi, starts, lengths))
+    pain = callpain + putpain
+    lowest = np.minimum.reduceat(pain, starts)
+    candidates = np.flatnonzero(pain == lowest[groups])
+    _, first = np.unique(groups[candidates], return_index=True)
+
+    results = np.empty(len(starts), dtype=DTYPE)
+    for column in ['fetch_id', 'time', 'expiration', 'dte', 'underlying']:
+        results[column] = chain[column][starts]
+    results['calloi'] = calls
+    results['putoi'] = puts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results['pcratio'] = np.where(calls > 0, puts / calls, np.nan)
+        results['predictor'] = np.where(total > 0, weighted / total, np.nan)
+    results['maxpain'] = np.where(total > 0, strikes[candidates[first]], np.nan)
+    return results
+
+
+class OpenInterestHistory(object):
+    def __init__(self, name='SPY', since=None):
+        ''' Open Interest Analytics of Every Fetch of a Tradable, computed from a
+            single streaming query of its history (since the given time)
+        '''
+        self.name = name
+        self.since = since
+        self.tradable = session.query(Tradable).filter_by(name=name).first()
+
+    def series(self, batchsize=50000):
+        ''' Get the analytics of every (fetch, expiration), as a structured
+            array ordered by fetch & expiration. Fetches are analyzed a batch
+            at a time, as they stream
+        '''
+        start = time.time()
+        results = [
+            analyze(batch)
+            for batch in iterfetches(self.tradable, columns=COLUMNS, since=self.since, batchsize=batchsize)
+        ]
+        series = np.concatenate(results) if results else np.empty(0, dtype=DTYPE)
+        print('Computed %s Open Interest Analytics For %s In %.2fs' % (len(series), self.name, time.time() - start))
+        return series
+
+    def nearest(self, series=None):
+        ''' Get the analytics of the nearest expiration of every fetch
+        '''
+        series = self.series() if series is None else series
+        if not len(series):
+            return series
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(series['fetch_id'])) + 1])
+        return series[starts]
+
+
+if __name__ == '__main__':
+    history = OpenInterestHistory(sys.argv[1] if len(sys.argv) > 1 else 'SPY')
+    for record in history.nearest():
+        print('%s %s: Predictor %.2f, Max Pain %.2f, Put/Call %.2f (Spot %.2f)' % (
+            record['time'].item().strftime('%Y-%m-%d %H:%M'),
+            record['expiration'],
+            record['predictor'],
+            record['maxpain'],
+            record['pcratio'],
+            record['underlying'],
+        ))
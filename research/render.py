@@ -0,0 +1,158 @@
+import io
+import time
+import struct
+import multiprocessing
+import numpy as np
+from PIL import Image
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+try:
+    import imageio
+except ImportError:
+    imageio = None
+
+
+class Painter(object):
+    ''' Reusable Frame Painter. Every worker process builds a single figure and
+        its artists once (in setup), and then only updates their data for each
+        frame (in draw), rather than re-creating a figure per frame
+    '''
+    figsize = (16, 8)
+    dpi = 100
+
+    def __init__(self, **options):
+        self.figure = Figure(figsize=self.figsize, dpi=self.dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.setup(**options)
+
+    def setup(self, **options):
+        ''' Build the figure's artists
+        '''
+        raise NotImplementedError
+
+    def draw(self, frame):
+        ''' Update the figure's artists with the given frame's data
+        '''
+        raise NotImplementedError
+
+    def paint(self, frame):
+        ''' Draw the given frame, as an RGB image array
+        '''
+        self.draw(frame)
+        self.canvas.draw()
+        return np.asarray(self.canvas.buffer_rgba())[:, :, :3].copy()
+
+
+# Each worker process's painter:
+painter = None
+
+def startworker(cls, options):
+    global painter
+    painter = cls(**options)
+
+def paintframe(frame):
+    return painter.paint(frame)
+
+
+def paint(frames, cls, processes=None, **options):
+    ''' Paint the given frames with the given Painter class (built with the
+        given options) across a pool of `processes` processes (all cores by
+        default), yielding their RGB images in order
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    with multiprocessing.Pool(processes, initializer=startworker, initargs=(cls, options)) as pool:
+        for image in pool.imap(paintframe, frames, chunksize=4):
+            yield image
+
+
+class GifWriter(object):
+    def __init__(self, path, size, duration=100):
+        ''' Animated GIF Writer, that encodes & writes every frame as soon as it
+            is appended, so memory use doesn't grow with the number of frames.
+            Each frame is quantized with Pillow, and keeps its own palette as a
+            local color table. `duration` is the time per frame, in ms
+        '''
+        self.file = open(path, 'wb')
+        self.duration = duration
+        self.count = 0
+
+        # Header & logical screen, without a global color table, looping forever:
+        width, height = size
+        self.file.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0, 0, 0))
+        self.file.write(b'!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, image):
+        ''' Encode & write the given RGB image array as the next frame
+        '''
+        frame = Image.fromarray(image).convert('P', palette=Image.Palette.ADAPTIVE)
+        buffer = io.BytesIO()
+        frame.save(buffer, format='GIF')
+        data = buffer.getvalue()
+
+        # Take the single frame's global color table:
+        flags = data[10]
+        tablesize = 3 * 2 ** ((flags & 7) + 1) if flags & 0x80 else 0
+        palette = data[13:13 + tablesize]
+
+        # Skip any extension blocks, up to the image descriptor:
+        position = 13 + tablesize
+        while data[position:position + 1] == b'!':
+            position += 2
+            while data[position]:
+                position += data[position] + 1
+            position += 1
+
+        # Write the frame delay, then the image with the palette as its local
+        # color table, and its compressed data (without the trailer):
+        descriptor = bytearray(data[position:position + 10])
+        descriptor[9] = (descriptor[9] & 0x40) | (0x80 | (flags & 7) if palette else 0)
+        self.file.write(b'!\xf9\x04\x00' + struct.pack('<H', int(self.duration / 10)) + b'\x00\x00')
+        self.file.write(bytes(descriptor) + palette + data[position + 10:-1])
+        self.count += 1
+
+    def close(self):
+        if not self.file.closed:
+            self.file.write(b';')
+            self.file.close()
+
+
+def save(images, path, fps=10):
+    ''' Stream the given RGB images into an animated GIF or, for any other
+        extension, a video (with imageio). Returns the frame count
+    '''
+    images = iter(images)
+    if path.lower().endswith('.gif'):
+        first = next(images, None)
+        if first is None:
+            return 0
+        with GifWriter(path, (first.shape[1], first.shape[0]), duration=1000. / fps) as writer:
+            writer.append(first)
+            for image in images:
+                writer.append(image)
+        return writer.count
+
+    if imageio is None:
+        raise ImportError('Writing videos requires imageio (pip install imageio imageio-ffmpeg)')
+    count = 0
+    with imageio.get_writer(path, fps=fps) as writer:
+        for image in images:
+            writer.append_data(image)
+            count += 1
+    return count
+
+
+def render(frames, cls, path, fps=10, processes=None, **options):
+    ''' Render the given frames with the given Painter class across a process
+        pool, straight into an animated GIF or video at the given path
+    '''
+    start = time.time()
+    count = save(paint(frames, cls, processes=processes, **options), path, fps=fps)
+    print('Rendered %s Frames To %s in %.2fs' % (count, path, time.time() - start))
+    return count
@@ -1,25 +1,41 @@
+import os
 import time
 import datetime
 import traceback
+import numpy as np
 import matplotlib.pyplot as plt
-from db.models import Tradable, Option, OptionData, session
+from matplotlib.lines import Line2D
+from td.database.models import *
+from td.database.config import db_config
+from td.database.chains import COLUMNS, cache, loadchain, iterfetches
+from td.research.render import Painter, render
 
-def plotchain(chain, filename, title, ylower=0, yupper=40):
-    # todo: https://stackoverflow.com/questions/753190/programmatically-generate-video-or-animated-gif-in-python/35943809#35943809
-    plt.figure(figsize=(16, 8))
-    # Sort the chain by delta:
-    for (ctype, color) in [('CALL', (1.0, 0, 0)), ('PUT', (0, 0, 1.0))]:
-        values = chain[ctype]
+session = db_config.session
 
-        # bin by DTE:
+def tocurves(chain):
+    ''' Convert { type -> [(delta, iv, dte)] } ladders into per-expiration
+        curves, as { type -> [(dte, deltas, ivs)] } sorted by delta
+    '''
+    curves = {}
+    for ctype, values in chain.items():
         expirations = {}
         for delta, vol, dte in values:
             expirations.setdefault(dte, []).append((delta, vol))
-        for dte, ladder in expirations.iteritems():
+        curves[ctype] = []
+        for dte, ladder in expirations.items():
             # Sort by delta:
             ladder.sort()
             deltas, vols = zip(*ladder)
+            curves[ctype].append((dte, deltas, vols))
+    return curves
+
 
+def plotcurves(curves, filename, title, ylower=0, yupper=40):
+    ''' Plot the given { type -> [(dte, deltas, ivs)] } skew curves
+    '''
+    plt.figure(figsize=(16, 8))
+    for (ctype, color) in [('CALL', (1.0, 0, 0)), ('PUT', (0, 0, 1.0))]:
+        for dte, deltas, vols in curves.get(ctype, []):
             # Determine the Color and Line Width:
             alpha = (1. / (dte + 1)) ** 0.25
             colors = color + (alpha,)
@@ -38,11 +54,16 @@ def plotchain(chain, filename, title, ylower=0, yupper=40):
     plt.legend(['Calls', 'Puts'])
     # plt.show()
     plt.savefig(filename, edgecolor='black')
-    print 'Saved New Skew Chart %s' % filename
+    plt.close()
+    print('Saved New Skew Chart %s' % filename)
+
+
+def plotchain(chain, filename, title, ylower=0, yupper=40):
+    plotcurves(tocurves(chain), filename, title, ylower=ylower, yupper=yupper)
 
 
 def makechart(filename, title, name='SPY', yupper=40, maxspread=0.1):
-    print 'Constructing Skew Chart for %s...' % name
+    print('Constructing Skew Chart for %s...' % name)
     start = time.time()
 
     # Get the most recent options chain:
@@ -50,116 +71,248 @@ def makechart(filename, title, name='SPY', yupper=40, maxspread=0.1):
 
     # Plot the most recent options chain:
     plotchain(chain, filename, title, ylower=0, yupper=yupper)
-    print 'Finished makechart in %.2fs' % (time.time() - start)
+    print('Finished makechart in %.2fs' % (time.time() - start))
+
+def getladders(chain, maxspread=0.1, maxiv=None):
+    ''' Split a loaded options chain into { type -> [(delta, iv, dte)] } ladders,
+        filtering by the given maximum bid/ask spread (and implied vol)
+    '''
+    valid = np.abs(chain['bid'] - chain['ask']) <= maxspread
+    if maxiv is not None:
+        valid &= np.abs(chain['volatility']) < maxiv
+    ladders = {}
+    for ctype in ('PUT', 'CALL'):
+        mask = valid & (chain['type'] == ctype)
+        ladders[ctype] = list(zip(
+            chain['delta'][mask].tolist(),
+            chain['volatility'][mask].tolist(),
+            chain['dte'][mask].tolist(),
+        ))
+    return ladders
+
 
 def getchain(name='SPY', maxspread=0.1):
     ''' Get the most recent options chain for the given tradable, filtering by
         the given maximum bid/ask spread
     '''
-    tradable = session.query(Tradable).filter_by(name=name).first()
+    print('Loading Most Recent %s Options Chain...' % name)
+    chain = loadchain(name, columns=['type', 'bid', 'ask', 'delta', 'volatility', 'dte'])
 
-    # Get All Option IDs for this Tradable:
-    print 'Fetching %s Options...' % tradable.name
-    query = session.execute("SELECT id FROM options WHERE tradable_id=%s;" % tradable.id)
-    optionids = [str(id) for (id,) in query]
-
-    # Get the Time of The Most Recent Options Data Query For this Tradable:
-    print 'Determining Most Recent Fetch Time...'
-    query = session.execute("SELECT MAX(time) FROM options_data WHERE option_id IN (%s);" % ', '.join(optionids))
-    mostrecent = list(query)[0][0]
-    print 'Most recent Fetch Was: %s' % mostrecent
-
-    # Get the options data ids for the most recent fetch:
-    print 'Fetching Most Recent Fetch Options Data IDs...'
-    query = session.execute("SELECT id FROM options_data WHERE time='%s';" % str(mostrecent))
-    dataids = [int(id) for (id,) in query]
-
-    # Get all the options Values:
-    print 'Collecting Options Data Records From Most Recent API Fetch...'
-    values = session.query(OptionData).filter(OptionData.id.in_(dataids)).all()
-
-    print 'Constructing Options Chain...'
-    chain = {
-        'PUT': [],
-        'CALL': []
-    }
-    for value in values:
-        if abs(value.bid - value.ask) <= maxspread and abs(value.volatility) < 100.0:
-            chain[value.option.type].append((
-                float(value.delta), # if delta >= 0 else delta * -5.,
-                float(value.volatility),
-                value.dte
-            ))
-    return chain
-
-
-def getchains(name='SPY'):
+    print('Constructing Options Chain...')
+    return getladders(chain, maxspread=maxspread, maxiv=100.0)
+
+
+def getchains(name='SPY', maxspread=0.1):
+    ''' Get every historical options chain snapshot of the given tradable, as
+        { fetch time -> { type -> [(delta, iv, dte)] } }. Snapshots are read
+        through the on-disk snapshot cache
+    '''
     start = time.time()
     tradable = session.query(Tradable).filter_by(name=name).first()
+    fetches = session.query(OptionsFetch).filter_by(tradable_id=tradable.id).order_by(OptionsFetch.time).all()
 
-    # Get a list of timestamps:
-    query = session.execute('SELECT time, count(*) from options_data group by time;')
-    timestamps = [str(timestamp) for timestamp, count in query if count > 500]
-
-    chains = {
-        timestamp: {
-            'PUT': [],
-            'CALL': []
-        }
-        for timestamp in timestamps
-    }
-
-    for ctype in ('CALL', 'PUT'):
-        # Get all valid option ids for this tradable:
-        query = session.execute(
-            "SELECT id FROM options WHERE type='%s' AND tradable_id=%s;" % (
-                ctype,
-                tradable.id
-            )
-        )
-        optionids = [str(id) for (id,) in query]
-
-        for timestamp in timestamps:
-            print 'Loading %s Options Data from %s...' % (ctype, timestamp)
-            query = session.execute(
-                "SELECT bid, ask, dte, delta, volatility FROM options_data WHERE time='%s' AND option_id IN (%s);" % (
-                timestamp,
-                ', '.join(optionids)
-            ))
-            for bid, ask, dte, delta, volatility in query:
-                if abs(bid - ask) < 0.10:
-                    chains[timestamp][ctype].append((
-                        float(delta),
-                        float(volatility),
-                        float(dte)
-                    ))
-
-    # Delete any empty/incomplete timestamps:
-    for timestamp in timestamps:
-        calls = chains[timestamp]['CALL']
-        puts = chains[timestamp]['PUT']
-        if not calls or not puts:
-            del chains[timestamp]
-
-    print 'Loaded %s Options Chain Snapshots in %.2fs' % (len(chains), time.time() - start)
+    chains = {}
+    for fetch in fetches:
+        print('Loading %s Options Data from %s...' % (name, fetch.time))
+        chain = loadchain(tradable, fetch, columns=['type', 'bid', 'ask', 'delta', 'volatility', 'dte'], cached=True)
+
+        # Skip any empty/incomplete snapshots:
+        if len(chain) <= 500:
+            continue
+        ladders = getladders(chain, maxspread=maxspread)
+        if ladders['CALL'] and ladders['PUT']:
+            chains[fetch.time] = ladders
+
+    print('Loaded %s Options Chain Snapshots in %.2fs' % (len(chains), time.time() - start))
     return chains
 
 
-def makegif(name='SPY', folder='skews/gifs'):
-    chains = getchains(name=name)
-    for timestamp, chain in chains.iteritems():
-        try:
-            dt = datetime.datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
-            filename = '%s/%s-%s.jpg' % (folder, name, dt.strftime('%s'))
-            plotchain(
-                chain=chain,
-                filename=filename,
-                title=dt.strftime('%a %b %d at %I:%M %p'),
-                ylower=0,
-                yupper=40
-            )
-        except:
-            print traceback.format_exc()
+class SkewEngine(object):
+    def __init__(self, name='SPY', maxspread=0.1, maxiv=None, minsize=500, since=None, cached=True):
+        ''' Computes the skew curves of every historical options chain snapshot
+            of a tradable in one batch. Snapshots are read from the on-disk
+            snapshot cache where possible (with `cached`), and the rest of the
+            history with a single streaming query, which also populates the
+            cache. Contracts are filtered by the given maximum bid/ask spread
+            (and implied vol) as they're read, and grouped into per-expiration
+            delta/IV curves with NumPy. Snapshots with no more than `minsize`
+            contracts are skipped as incomplete
+        '''
+        self.name = name
+        self.maxspread = maxspread
+        self.maxiv = maxiv
+        self.minsize = minsize
+        self.since = since
+        self.cached = cached
+        self.tradable = session.query(Tradable).filter_by(name=name).first()
+
+    def filter(self, records, sizes):
+        ''' Count the contracts of each fetch of the given records, and keep
+            only the columns & rows the curves need
+        '''
+        ids, counts = np.unique(records['fetch_id'], return_counts=True)
+        for id, count in zip(ids.tolist(), counts.tolist()):
+            sizes[id] = sizes.get(id, 0) + count
+
+        valid = np.abs(records['bid'] - records['ask']) <= self.maxspread
+        if self.maxiv is not None:
+            valid &= np.abs(records['volatility']) < self.maxiv
+        records = records[valid]
+
+        part = np.empty(len(records), dtype=[
+            ('fetch_id', 'i8'), ('time', 'datetime64[us]'), ('iscall', '?'),
+            ('delta', 'f8'), ('volatility', 'f8'), ('dte', 'i4'),
+        ])
+        part['fetch_id'] = records['fetch_id']
+        part['time'] = records['time']
+        part['iscall'] = records['type'] == 'CALL'
+        part['delta'] = records['delta']
+        part['volatility'] = records['volatility']
+        part['dte'] = records['dte']
+        return part
+
+    def load(self):
+        ''' Read the tradable's history, keeping only the columns & rows the
+            curves need. Returns the filtered records and the total number of
+            contracts of each fetch
+        '''
+        columns = ['fetch_id', 'time', 'type', 'bid', 'ask', 'delta', 'volatility', 'dte']
+        fetches = session.query(OptionsFetch.id, OptionsFetch.time).filter_by(tradable_id=self.tradable.id)
+        if self.since is not None:
+            fetches = fetches.filter(OptionsFetch.time >= self.since)
+        fetches = fetches.order_by(OptionsFetch.id).all()
+
+        # Read the cached snapshots from disk:
+        parts = []
+        sizes = {}
+        cached = [fetch for fetch in fetches if self.cached and os.path.exists(cache.path(fetch.id))]
+        for fetch in cached:
+            parts.append(self.filter(cache.load(fetch, columns=columns), sizes))
+
+        # Stream the rest, from the first uncached fetch on, caching every
+        # snapshot as it comes in:
+        skip = np.array([fetch.id for fetch in cached], dtype='i8')
+        missing = [fetch for fetch in fetches if fetch.id not in set(skip.tolist())]
+        if missing:
+            loaded = list(COLUMNS) if self.cached else columns
+            for batch in iterfetches(self.tradable, columns=loaded, since=missing[0].time):
+                batch = batch[~np.isin(batch['fetch_id'], skip)]
+                if not len(batch):
+                    continue
+                if self.cached:
+                    self.save(batch)
+                parts.append(self.filter(batch, sizes))
+
+        records = np.concatenate(parts) if parts else np.empty(0)
+        print('Loaded %s %s Snapshots (%s From The Cache)' % (len(sizes), self.name, len(cached)))
+        return records, sizes
+
+    def save(self, records):
+        ''' Write each complete fetch of the given records to the snapshot cache
+        '''
+        bounds = np.flatnonzero(np.diff(records['fetch_id'])) + 1
+        for group in np.split(records, bounds):
+            if len(group):
+                cache.save(int(group['fetch_id'][0]), group)
+
+    def frames(self):
+        ''' Compute the skew curves of every complete snapshot, as a list of
+            (fetch time, { type -> [(dte, deltas, ivs)] }) ordered by time
+        '''
+        start = time.time()
+        records, sizes = self.load()
+        if not len(records):
+            return []
+
+        # Drop the incomplete snapshots:
+        complete = np.array([id for id, size in sizes.items() if size > self.minsize])
+        records = records[np.isin(records['fetch_id'], complete)]
+
+        # Sort into contiguous curves, by fetch, type, expiration & delta:
+        records = records[np.lexsort((
+            records['volatility'],
+            records['delta'],
+            records['dte'],
+            records['iscall'],
+            records['fetch_id'],
+        ))]
+        fetchids, iscall, dtes = records['fetch_id'], records['iscall'], records['dte']
+        changes = (np.diff(fetchids) != 0) | (np.diff(iscall) != 0) | (np.diff(dtes) != 0)
+        starts = np.concatenate([[0], np.flatnonzero(changes) + 1])
+        ends = np.concatenate([starts[1:], [len(records)]])
+
+        frames = []
+        current = None
+        deltas, vols = records['delta'], records['volatility']
+        for begin, end in zip(starts.tolist(), ends.tolist()):
+            if current is None or fetchids[begin] != current:
+                current = fetchids[begin]
+                curves = {'CALL': [], 'PUT': []}
+                frames.append((records['time'][begin].item(), curves))
+            ctype = 'CALL' if iscall[begin] else 'PUT'
+            curves[ctype].append((int(dtes[begin]), deltas[begin:end], vols[begin:end]))
+
+        # Both sides of the chain are needed to plot a snapshot:
+        frames = [(dt, curves) for dt, curves in frames if curves['CALL'] and curves['PUT']]
+        frames.sort(key=lambda frame: frame[0])
+        print('Computed Skew Curves of %s %s Snapshots in %.2fs' % (len(frames), self.name, time.time() - start))
+        return frames
+
+
+class SkewPainter(Painter):
+    ''' Paints (title, { type -> [(dte, deltas, ivs)] }) skew chart frames,
+        reusing one line per curve across frames
+    '''
+    colors = [('CALL', (1.0, 0, 0)), ('PUT', (0, 0, 1.0))]
+
+    def setup(self, ylower=0, yupper=40):
+        self.axes = self.figure.add_subplot(1, 1, 1)
+        self.axes.set_xlim(-1, 1)
+        self.axes.set_ylim(ylower, yupper)
+        self.axes.axvline(x=0.5, color='black')
+        self.axes.axvline(x=-0.5, color='black')
+        self.axes.set_xlabel('Delta')
+        self.axes.set_ylabel('IV')
+        self.axes.legend(
+            [Line2D([], [], color=color) for _, color in self.colors],
+            ['Calls', 'Puts'],
+        )
+        self.title = self.axes.set_title('')
+        self.lines = {ctype: [] for ctype, _ in self.colors}
+
+    def draw(self, frame):
+        title, curves = frame
+        for ctype, color in self.colors:
+            lines = self.lines[ctype]
+            values = curves.get(ctype, [])
+            for index, (dte, deltas, vols) in enumerate(values):
+                if index == len(lines):
+                    lines.append(self.axes.plot([], [], '-')[0])
+
+                # Determine the Color and Line Width:
+                alpha = (1. / (dte + 1)) ** 0.25
+                lines[index].set_data(deltas, vols)
+                lines[index].set_color(color + (alpha,))
+                lines[index].set_linewidth(4 * alpha / 2)
+                lines[index].set_visible(True)
+
+            # Hide the lines left over from earlier frames:
+            for line in lines[len(values):]:
+                line.set_visible(False)
+        self.title.set_text(title)
+
+
+def makegif(name='SPY', path=None, fps=10, processes=None):
+    ''' Render a skew chart of every historical snapshot of the given tradable
+        into an animated GIF (or, for other extensions, a video), across a
+        pool of `processes` processes (all cores by default)
+    '''
+    path = path or 'skews/%s.gif' % name
+    frames = (
+        (dt.strftime('%a %b %d at %I:%M %p'), curves)
+        for dt, curves in SkewEngine(name=name).frames()
+    )
+    return render(frames, SkewPainter, path, fps=fps, processes=processes, ylower=0, yupper=40)
 
 if __name__ == '__main__':
     makegif()
@@ -1,24 +1,43 @@
 import time
-from db.models import session, Tradable
+from td.database.models import *
+from td.database.config import db_config
+
+session = db_config.session
 
 class OptionsStats(object):
     def __init__(self, tradable):
         self.tradable = tradable
         self.load()
 
+    def values(self, batchsize=10000):
+        ''' Stream all of this tradable's options data rows, as
+            (option id, time, bid, ask, volatility, openinterest)
+        '''
+        query = '''
+            SELECT d.option_id, d.time, d.bid, d.ask, d.volatility, d.openinterest
+            FROM options_data d
+            WHERE d.option_id = ANY(:optionids)
+            ORDER BY d.option_id, d.time
+        '''
+        params = {'optionids': self.optionids}
+        return db_config.stream(query, params, batchsize=batchsize)
+
     def load(self):
-        print 'Loading Options Data for %s...' % self.tradable
+        print('Loading Options Data for %s...' % self.tradable)
         start = time.time()
-        self.options = self.tradable.options
-        self.values = []
-        for option in self.options:
-            self.values.append(option.values)
-        print 'Loaded %s Data Points for %s Options Contracts for %s In %.2fs' % (
-            len(self.values),
-            len(self.options),
+        query = session.query(Option.id).filter_by(tradable_id=self.tradable.id)
+        self.optionids = [id for id, in query]
+
+        # Count the data points per contract, without holding them in memory:
+        self.counts = {}
+        for optionid, _, _, _, _, _ in self.values():
+            self.counts[optionid] = self.counts.get(optionid, 0) + 1
+        print('Loaded %s Data Points for %s Options Contracts for %s In %.2fs' % (
+            sum(self.counts.values()),
+            len(self.optionids),
             self.tradable,
             time.time() - start,
-        )
+        ))
 
 
 if __name__ == '__main__':
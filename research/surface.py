@@ -1,9 +1,13 @@
-import math
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib.colors import ListedColormap
-from db.models import *
+from td.database.chains import loadchain
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
 
 def addalpha(cmap):
     my_cmap = cmap(np.arange(cmap.N))
@@ -11,61 +15,121 @@ def addalpha(cmap):
     return ListedColormap(my_cmap)
 
 
+class VolSurface(object):
+    def __init__(self, chain, ctype='CALL', mindte=0, maxdte=1000, miniv=0., maxiv=1000., maxspread=1., neighbours=10):
+        ''' Implied Volatility Surface of the calls (or puts) of the given chain,
+            as loaded by td.database.chains.loadchain, on a moneyness (% from
+            spot) / DTE grid. Grid cells without a quote are filled with the
+            average IV of the `neighbours` nearest quoted cells, found with a
+            KD-Tree (when scipy is installed)
+        '''
+        self.ctype = ctype
+        self.spot = float(chain['underlying'][0])
+
+        # Check Type, DTE Range, Bid/Ask Spread, and Vol Range:
+        valid = chain['type'] == ctype
+        valid &= (mindte <= chain['dte']) & (chain['dte'] <= maxdte)
+        valid &= np.abs(chain['bid'] - chain['ask']) <= maxspread
+        valid &= (miniv <= chain['volatility']) & (chain['volatility'] <= maxiv)
+        chain = chain[valid]
+
+        moneyness = np.round((chain['strike'] - self.spot) / self.spot * 100., 3)
+        dtes = chain['dte'].astype(float)
+        self.moneyness = np.unique(moneyness)
+        self.dtes = np.unique(dtes)
+
+        # Place every quote on the grid:
+        self.ivs = np.full((len(self.dtes), len(self.moneyness)), np.nan)
+        rows = np.searchsorted(self.dtes, dtes)
+        cols = np.searchsorted(self.moneyness, moneyness)
+        self.ivs[rows, cols] = chain['volatility']
+
+        # Fill the holes with the average of the nearest quoted cells:
+        quoted = ~np.isnan(self.ivs)
+        holes = ~quoted | (self.ivs == 0)
+        if holes.any() and quoted.any():
+            rows, cols = np.nonzero(quoted)
+            points = np.column_stack([self.moneyness[cols], self.dtes[rows]])
+            values = self.ivs[rows, cols]
+            rows, cols = np.nonzero(holes)
+            targets = np.column_stack([self.moneyness[cols], self.dtes[rows]])
+            nearest = self.nearest(points, targets, min(neighbours, len(points)))
+            self.ivs[rows, cols] = values[nearest].mean(axis=1)
+
+    @classmethod
+    def nearest(cls, points, targets, count, chunksize=1000):
+        ''' Get the indexes of the `count` points nearest to each target
+        '''
+        if cKDTree is not None:
+            _, indexes = cKDTree(points).query(targets, k=count)
+            return indexes.reshape(len(targets), count)
+
+        # Without scipy, partition the distances a chunk of targets at a time:
+        indexes = np.empty((len(targets), count), dtype=int)
+        for i in range(0, len(targets), chunksize):
+            chunk = targets[i:i + chunksize]
+            distances = ((chunk[:, None, :] - points[None, :, :]) ** 2).sum(axis=2)
+            indexes[i:i + chunksize] = np.argpartition(distances, count - 1, axis=1)[:, :count]
+        return indexes
+
+    @classmethod
+    def fromchain(cls, chain, **kwargs):
+        ''' Build both the call & put surfaces of the given chain, as
+            { type -> VolSurface }
+        '''
+        return {ctype: cls(chain, ctype=ctype, **kwargs) for ctype in ['CALL', 'PUT']}
+
+    @property
+    def grid(self):
+        ''' Get the (moneyness, dte, iv) meshgrid of the surface
+        '''
+        X, Y = np.meshgrid(self.moneyness, self.dtes)
+        return X, Y, self.ivs
+
+    def iv(self, moneyness, dte):
+        ''' Get the implied volatility at the given moneyness(es) and DTE(s), by
+            bilinear interpolation of the grid (clamped to its edges)
+        '''
+        moneyness = np.clip(np.asarray(moneyness, dtype=float), self.moneyness[0], self.moneyness[-1])
+        dte = np.clip(np.asarray(dte, dtype=float), self.dtes[0], self.dtes[-1])
+
+        def locate(axis, values):
+            if len(axis) > 1:
+                upper = np.clip(np.searchsorted(axis, values), 1, len(axis) - 1)
+            else:
+                upper = np.zeros(values.shape, dtype=int)
+            lower = np.maximum(upper - 1, 0)
+            span = axis[upper] - axis[lower]
+            weight = np.divide(values - axis[lower], span, out=np.zeros_like(values), where=span > 0)
+            return lower, upper, weight
+
+        left, right, x = locate(self.moneyness, moneyness)
+        below, above, y = locate(self.dtes, dte)
+        ivs = self.ivs
+        return (
+            ivs[below, left] * (1 - x) * (1 - y) +
+            ivs[below, right] * x * (1 - y) +
+            ivs[above, left] * (1 - x) * y +
+            ivs[above, right] * x * y
+        )
+
+
 def plotsurface(surface, mindte=0, maxdte=1000, miniv=0., maxiv=1000., maxspread=1.):
+    ''' Plot the call & put implied volatility surfaces of the given chain, as
+        loaded by td.database.chains.loadchain
     '''
-    '''
-    ctypes = ['CALL', 'PUT']
-    spot = float(surface[0].underlying)
-    getmoneyness = lambda o: round((float(o.option.strike) - spot) / spot * 100., 3)
-    spread = lambda o: abs(float(o.bid) - float(o.ask))
-    mapping = {ctype: {} for ctype in ctypes}
-
-    for option in surface:
-        # Check DTE Range:
-        if mindte <= option.dte <= maxdte:
-            # Check Bid/Ask Spread:
-            if spread(option) <= maxspread:
-                # Check Vol Range:
-                if miniv <= float(option.volatility) <= maxiv:
-                    # All checks passed, add item to mapping:
-                    moneyness = getmoneyness(option)
-                    dte = option.dte
-                    iv = float(option.volatility)
-                    key = (moneyness, dte)
-                    otype = option.option.type
-                    mapping[otype][key] = iv
-
+    surfaces = VolSurface.fromchain(
+        surface,
+        mindte=mindte,
+        maxdte=maxdte,
+        miniv=miniv,
+        maxiv=maxiv,
+        maxspread=maxspread,
+    )
 
     # Plot the Calls and Puts surfaces:
-    for ctype in ctypes:
-
-        # Get sorted list of strikes and dtes:
-        points = mapping[ctype].keys()
-        strikes, dtes = zip(*points)
-        strikes = sorted(set(strikes))
-        dtes = sorted(set(dtes))
-
-        def closest(point, count=1):
-            distance = lambda p: math.sqrt((point[0] - p[0]) ** 2 + (point[1] - p[1]) ** 2)
-            return sorted(points, key=distance)[:count]
-
-
-        # plot a 3D surface like in the example mplot3d/surface3d_demo
-        X, Y = np.meshgrid(strikes, dtes)
-        Z = np.full(X.shape, np.nan)
-
-        for i, strike in enumerate(strikes):
-            for j, dte in enumerate(dtes):
-                iv = mapping[ctype].get((strike, dte))
-                if iv:
-                    Z[j, i] = iv
-                else:
-                    # Take the average of the three closest points as the IV:
-                    closestpnts = closest((strike, dte), count=10)
-                    closestivs = [mapping[ctype][item] for item in closestpnts]
-                    iv = sum(closestivs) / float(len(closestivs))
-                    Z[j, i] = iv
-
+    for ctype, volsurface in surfaces.items():
+        X, Y, Z = volsurface.grid
 
         # Set up and plot figure:
         fig = plt.figure(figsize=(15, 8))
@@ -80,6 +144,5 @@ def plotsurface(surface, mindte=0, maxdte=1000, miniv=0., maxiv=1000., maxspread
 
 
 if __name__ == '__main__':
-    spy = session.query(Tradable).filter_by(name='SPY').first()
-    surface = spy.fetches[-1].values
+    surface = loadchain('SPY', columns=['type', 'strike', 'dte', 'bid', 'ask', 'volatility', 'underlying'])
     plotsurface(surface, maxdte=100, miniv=5., maxiv=100., maxspread=0.5)
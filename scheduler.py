@@ -0,0 +1,198 @@
+import os
+import time
+import logging
+import datetime
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from td.options import OptionsDataClient
+from td.database.models import *
+from td.database.config import db_config
+from td.database.partitions import Partitions
+
+log = logging.getLogger('td.scheduler')
+
+class RateLimiter(object):
+    def __init__(self, rate=120, period=60.):
+        ''' Thread-Safe Token Bucket, allowing at most `rate` requests per
+            `period` seconds
+        '''
+        self.rate = float(rate)
+        self.period = float(period)
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        ''' Block until a request may be made
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate / self.period)
+                self.last = now
+                if self.tokens >= 1.:
+                    self.tokens -= 1.
+                    return
+                wait = (1. - self.tokens) * self.period / self.rate
+            time.sleep(wait)
+
+
+class FetchScheduler(object):
+    def __init__(self, client=None, concurrency=4, writers=2, interval=60., intervals=None,
+                 rate=120, period=60., refresh=60., retention=None):
+        ''' Scheduler for Concurrently Fetching the Options Chains of all Enabled
+            Tradables. Chains are downloaded on a pool of `concurrency` threads
+            (throttled to `rate` requests per `period` seconds), then handed off
+            to a separate pool of `writers` threads for parsing & saving, so a
+            slow response never holds up the other tradables.
+
+            Each tradable is fetched every `interval` seconds, unless overridden
+            in the `intervals` mapping of { name -> seconds }. Once a day the
+            upcoming options_data partitions are created, and if `retention` is
+            given, partitions older than that many months are detached
+        '''
+        self.client = client or OptionsDataClient()
+        self.interval = interval
+        self.intervals = intervals or {}
+        self.refresh = refresh
+        self.retention = retention
+        self.limiter = RateLimiter(rate, period)
+        self.downloads = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='td-fetch')
+        self.writes = ThreadPoolExecutor(max_workers=writers, thread_name_prefix='td-write')
+
+        self.names = []
+        self.nextrun = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def tradables(self):
+        ''' Get the names of all enabled Tradables
+        '''
+        try:
+            query = db_config.session.query(Tradable.name).filter_by(enabled=True)
+            return [name for name, in query]
+        finally:
+            db_config.session.remove()
+
+    def maintain(self):
+        ''' Create the upcoming options_data partitions, and detach expired ones
+        '''
+        try:
+            Partitions.ensure()
+            if self.retention:
+                Partitions.retain(months=self.retention)
+        except:
+            log.error('An Error Occurred On Maintaining Partitions...')
+            log.error(traceback.format_exc())
+            db_config.session.rollback()
+        finally:
+            db_config.session.remove()
+
+    def reload(self, isopen=False):
+        ''' Reload the enabled Tradables & check market hours, returning whether
+            the market is open. On an error the previous tradables (and market
+            state) are kept, until the next refresh
+        '''
+        try:
+            self.names = self.tradables()
+            return OptionsDataClient.ismarketopen()
+        except:
+            log.error('An Error Occurred On Refreshing Tradables, Keeping %s...' % self.names)
+            log.error(traceback.format_exc())
+            db_config.session.rollback()
+            return isopen
+        finally:
+            db_config.session.remove()
+
+    def due(self):
+        ''' Get the names of all Tradables that are due to be fetched
+        '''
+        now = time.time()
+        with self.lock:
+            return [
+                name for name in self.names
+                if name not in self.pending and self.nextrun.get(name, 0) <= now
+            ]
+
+    def submit(self, name):
+        ''' Schedule the given Tradable to be fetched
+        '''
+        with self.lock:
+            self.pending.add(name)
+            self.nextrun[name] = time.time() + self.intervals.get(name, self.interval)
+        self.downloads.submit(self._download, name)
+
+    def _download(self, name):
+        ''' Download the given Tradable's options chain, and queue it for saving
+        '''
+        try:
+            self.limiter.acquire()
+            start = time.time()
+            response = self.client.download(name)
+            log.info('Downloaded %s Options Chain In %.2fs' % (name, time.time() - start))
+            self.writes.submit(self._store, name, response)
+        except:
+            log.error('An Error Occurred On Downloading %s Options, Skipping...' % name)
+            log.error(traceback.format_exc())
+            self._done(name)
+
+    def _store(self, name, response):
+        ''' Parse & save a downloaded options chain
+        '''
+        try:
+            start = time.time()
+            tradable = self.client.store(name, response)
+            log.info('Finished Saving %s Options Data In %.2fs' % (tradable, time.time() - start))
+        except:
+            log.error('An Error Occurred On Saving %s Options, Skipping...' % name)
+            log.error(traceback.format_exc())
+            db_config.session.rollback()
+        finally:
+            db_config.session.remove()
+            self._done(name)
+
+    def _done(self, name):
+        with self.lock:
+            self.pending.discard(name)
+
+    def run(self, tick=1.):
+        ''' Fetch all enabled Tradables on their schedules, for as long as the
+            market is open
+        '''
+        refreshed = 0
+        maintained = None
+        isopen = False
+        try:
+            while True:
+                if maintained != datetime.date.today():
+                    self.maintain()
+                    maintained = datetime.date.today()
+
+                # Periodically reload the enabled tradables & check market hours:
+                if time.time() - refreshed > self.refresh:
+                    isopen = self.reload(isopen)
+                    refreshed = time.time()
+
+                if isopen:
+                    for name in self.due():
+                        self.submit(name)
+                time.sleep(tick)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        ''' Wait for all in-flight fetches to finish
+        '''
+        self.downloads.shutdown(wait=True)
+        self.writes.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    scheduler = FetchScheduler(
+        client=OptionsDataClient(delta=bool(os.environ.get('TDDELTA'))),
+        concurrency=int(os.environ.get('TDCONCURRENCY', 4)),
+        interval=float(os.environ.get('TDINTERVAL', 60)),
+        retention=int(os.environ['TDRETENTION']) if os.environ.get('TDRETENTION') else None,
+    )
+    scheduler.run()
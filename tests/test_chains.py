@@ -0,0 +1,89 @@
+import datetime
+import numpy as np
+from collections import namedtuple
+from td.database.chains import COLUMNS, reconstruct
+
+Fetch = namedtuple('Fetch', ['id', 'time', 'keyframe_id', 'unchanged', 'underlying', 'riskfree'])
+
+LOADED = ['fetch_id', 'option_id', 'time', 'expiration', 'bid', 'underlying']
+
+
+def records(fetch, quotes, expirations):
+    ''' Build the records of the given { option id -> bid } quotes of a fetch
+    '''
+    rows = np.empty(len(quotes), dtype=[(column, COLUMNS[column][1]) for column in LOADED])
+    rows['fetch_id'] = fetch.id
+    rows['option_id'] = list(quotes)
+    rows['time'] = fetch.time
+    rows['expiration'] = [expirations[id] for id in quotes]
+    rows['bid'] = list(quotes.values())
+    rows['underlying'] = fetch.underlying
+    return rows
+
+
+def snapshot(records, fetchid):
+    ''' Get a fetch's { option id -> (bid, underlying, time) } from the records
+    '''
+    records = records[records['fetch_id'] == fetchid]
+    return {
+        int(record['option_id']): (float(record['bid']), float(record['underlying']), record['time'])
+        for record in records
+    }
+
+
+def test_partial_fetches_rebuild_to_full_snapshots():
+    day = datetime.datetime(2024, 1, 2, 15)
+    expirations = {id: np.datetime64('2024-02-16') for id in range(1, 6)}
+    keyframe = Fetch(1, day, None, None, 100., 0.05)
+    first = Fetch(2, day + datetime.timedelta(minutes=1), 1, [1, 3, 5], 101., 0.05)
+    second = Fetch(3, day + datetime.timedelta(minutes=2), 1, [2, 3, 4, 5], 102., 0.05)
+    full = {
+        1: {1: 1., 2: 2., 3: 3., 4: 4., 5: 5.},
+        2: {1: 1., 2: 2.5, 3: 3., 4: 4.5, 5: 5.},
+        3: {1: 1.5, 2: 2.5, 3: 3., 4: 4.5, 5: 5.},
+    }
+    stored = np.concatenate([
+        records(keyframe, full[1], expirations),
+        records(first, {2: 2.5, 4: 4.5}, expirations),
+        records(second, {1: 1.5}, expirations),
+    ])
+
+    # Split the batches mid-fetch, like a server-side cursor would:
+    rebuilt = np.concatenate(list(reconstruct([stored[:3], stored[3:6], stored[6:]], [first, second])))
+    for fetch in (keyframe, first, second):
+        expected = {id: (bid, fetch.underlying, np.datetime64(fetch.time)) for id, bid in full[fetch.id].items()}
+        assert snapshot(rebuilt, fetch.id) == expected
+    assert np.all(np.diff(rebuilt['fetch_id']) >= 0)
+
+
+def test_expired_options_are_forgotten():
+    day = datetime.datetime(2024, 1, 2, 15)
+    expirations = {1: np.datetime64('2024-01-02'), 2: np.datetime64('2024-01-05')}
+    keyframe = Fetch(1, day, None, None, 100., 0.05)
+    sameday = Fetch(2, day + datetime.timedelta(hours=1), 1, [1, 2], 100., 0.05)
+    nextday = Fetch(3, day + datetime.timedelta(days=1), 1, [], 101., 0.05)
+    later = Fetch(4, day + datetime.timedelta(days=1, hours=1), 1, [1, 2], 101., 0.05)
+    stored = np.concatenate([
+        records(keyframe, {1: 1., 2: 2.}, expirations),
+        records(nextday, {2: 2.5}, expirations),
+    ])
+
+    rebuilt = np.concatenate(list(reconstruct([stored], [sameday, nextday, later])))
+    assert set(snapshot(rebuilt, 2)) == {1, 2}
+    # The option expired the day before, so it's no longer kept to carry:
+    assert snapshot(rebuilt, 4) == {2: (2.5, 101., np.datetime64(later.time))}
+
+
+def test_only_fetches_from_first_are_yielded():
+    day = datetime.datetime(2024, 1, 2, 15)
+    expirations = {1: np.datetime64('2024-02-16'), 2: np.datetime64('2024-02-16')}
+    keyframe = Fetch(1, day, None, None, 100., 0.05)
+    partial = Fetch(2, day + datetime.timedelta(minutes=1), 1, [1], 101., 0.05)
+    batches = [records(keyframe, {1: 1., 2: 2.}, expirations), records(partial, {2: 2.5}, expirations)]
+
+    rebuilt = list(reconstruct(batches, [partial], first=2))
+    assert all(len(batch) for batch in rebuilt)
+    assert snapshot(np.concatenate(rebuilt), 2) == {
+        1: (1., 101., np.datetime64(partial.time)),
+        2: (2.5, 101., np.datetime64(partial.time)),
+    }